@@ -0,0 +1,36 @@
+"""Search indexes
+
+Revision ID: 3c9d4e1f2a7b
+Revises: 02a11ba7d361
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d4e1f2a7b'
+down_revision = '02a11ba7d361'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_users_lower_login', 'users', [sa.text('lower(login) text_pattern_ops')])
+    op.create_index('ix_users_first_name_trgm', 'users', ['first_name'],
+                    postgresql_using='gin', postgresql_ops={'first_name': 'gin_trgm_ops'})
+    op.create_index('ix_users_last_name_trgm', 'users', ['last_name'],
+                    postgresql_using='gin', postgresql_ops={'last_name': 'gin_trgm_ops'})
+    op.create_index('ix_users_birthday', 'users', ['birthday'])
+    op.execute('CREATE INDEX ix_users_active_id ON users (id) INCLUDE (login, first_name, last_name) '
+               'WHERE NOT disabled')
+
+
+def downgrade():
+    op.drop_index('ix_users_active_id', table_name='users')
+    op.drop_index('ix_users_birthday', table_name='users')
+    op.drop_index('ix_users_last_name_trgm', table_name='users')
+    op.drop_index('ix_users_first_name_trgm', table_name='users')
+    op.drop_index('ix_users_lower_login', table_name='users')
@@ -0,0 +1,85 @@
+"""Change feed
+
+Revision ID: 5d1e7a9c3b20
+Revises: 3c9d4e1f2a7b
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1e7a9c3b20'
+down_revision = '3c9d4e1f2a7b'
+branch_labels = None
+depends_on = None
+
+
+NOTIFY_FUNCTION = """CREATE OR REPLACE FUNCTION notify_user_event() RETURNS trigger AS $$
+DECLARE
+    changed record;
+    event_op text;
+    event_id bigint;
+    event_user_id integer;
+    event_login text;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('user_events'));
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+        event_op := 'delete';
+    ELSIF TG_OP = 'INSERT' THEN
+        changed := NEW;
+        event_op := 'create';
+    ELSE
+        changed := NEW;
+        event_op := 'edit';
+    END IF;
+
+    IF TG_TABLE_NAME = 'users' THEN
+        event_user_id := changed.id;
+        event_login := changed.login;
+        IF TG_OP = 'UPDATE' THEN
+            IF NEW.disabled AND NOT OLD.disabled THEN
+                event_op := 'disable';
+            ELSIF OLD.disabled AND NOT NEW.disabled THEN
+                event_op := 'enable';
+            END IF;
+        END IF;
+    ELSE
+        event_user_id := changed.users_id;
+    END IF;
+
+    INSERT INTO user_events (table_name, op, user_id, login)
+    VALUES (TG_TABLE_NAME, event_op, event_user_id, event_login)
+    RETURNING id INTO event_id;
+    PERFORM pg_notify('user_events', json_build_object(
+        'id', event_id, 'table', TG_TABLE_NAME, 'op', event_op,
+        'user_id', event_user_id, 'login', event_login)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql"""
+
+
+def upgrade():
+    op.create_table(
+        'user_events',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('table_name', sa.String(length=32), nullable=False),
+        sa.Column('op', sa.String(length=16), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('login', sa.String(length=128), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(NOTIFY_FUNCTION)
+    for table in ('users', 'permissions'):
+        op.execute(f'CREATE TRIGGER {table}_notify AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                   'FOR EACH ROW EXECUTE PROCEDURE notify_user_event()')
+
+
+def downgrade():
+    for table in ('permissions', 'users'):
+        op.execute(f'DROP TRIGGER {table}_notify ON {table}')
+    op.execute('DROP FUNCTION notify_user_event()')
+    op.drop_table('user_events')
@@ -0,0 +1,25 @@
+"""User version
+
+Revision ID: 7b4f0c2e9d15
+Revises: 5d1e7a9c3b20
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b4f0c2e9d15'
+down_revision = '5d1e7a9c3b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # постоянное значение по умолчанию: столбец добавляется без перезаписи таблицы
+    op.add_column('users', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'version')
@@ -0,0 +1,31 @@
+"""Deferred change feed triggers
+
+Revision ID: 9e2a6c4d8f31
+Revises: 7b4f0c2e9d15
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9e2a6c4d8f31'
+down_revision = '7b4f0c2e9d15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # триггеры срабатывают при фиксации: advisory lock ленты держится только на время COMMIT,
+    # а не всю транзакцию
+    for table in ('users', 'permissions'):
+        op.execute(f'DROP TRIGGER {table}_notify ON {table}')
+        op.execute(f'CREATE CONSTRAINT TRIGGER {table}_notify AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                   'DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE PROCEDURE notify_user_event()')
+
+
+def downgrade():
+    for table in ('users', 'permissions'):
+        op.execute(f'DROP TRIGGER {table}_notify ON {table}')
+        op.execute(f'CREATE TRIGGER {table}_notify AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                   'FOR EACH ROW EXECUTE PROCEDURE notify_user_event()')
@@ -0,0 +1,375 @@
+"""Нагрузочные замеры API
+
+Задержка GET / без нагрузки и под потоком логинов; без --url приложение поднимается
+в этом же процессе:
+    python bench.py login-load --url http://127.0.0.1:8080 --duration 10
+
+В приложении, поднятом бенчмарком, ограничения входа заменяются на BENCH_LOGIN_LIMITS
+(--keep-login-limits оставляет настройки из конфига); примененные ограничения пишутся
+в meta результата.
+
+Замер всех маршрутов на приложении, поднятом в этом же процессе поверх локального
+PostgreSQL из config/my_app.yaml (--seed пересоздает таблицы и заполняет их --users пользователями):
+    python bench.py routes --seed --users 100000 --output bench.json --baseline bench_baseline.json
+
+Сравнение драйверов aiopg и asyncpg на фиксированных запросах репозитория (база должна быть заполнена):
+    python bench.py backends --users 100000 --requests 5000
+"""
+import argparse
+import asyncio
+import collections
+import copy
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+
+
+# ограничения входа для замеров: с настройками из конфига login упирается в 429
+# и замер показывает стоимость отказа, а не проверки пароля
+BENCH_LOGIN_LIMITS = {
+    'per_login': {'rate': 1000000, 'burst': 1000000},
+    'per_ip': {'rate': 1000000, 'burst': 1000000},
+    'max_concurrent': 1000000,
+    'max_keys': 100000,
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summary(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def hammer(session, method, url, deadline, latencies=None, statuses=None, **kwargs):
+    """Последовательная отправка запросов до наступления deadline"""
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        async with session.request(method, url, **kwargs) as resp:
+            await resp.read()
+        if latencies is not None:
+            latencies.append(time.monotonic() - started)
+        if statuses is not None:
+            statuses[resp.status] += 1
+
+
+async def measure_index(session, url, duration, concurrency, background=()):
+    deadline = time.monotonic() + duration
+    latencies = []
+    started = time.monotonic()
+    workers = [hammer(session, 'GET', url + '/', deadline, latencies) for _ in range(concurrency)]
+    workers += [worker(deadline) for worker in background]
+    await asyncio.gather(*workers)
+    return summary(latencies, time.monotonic() - started)
+
+
+def bench_config(keep_login_limits: bool) -> dict:
+    """Конфиг приложения для замера в этом же процессе"""
+    from settings import config
+
+    conf = copy.deepcopy(config)
+    if not keep_login_limits:
+        conf['login_limits'] = copy.deepcopy(BENCH_LOGIN_LIMITS)
+    return conf
+
+
+async def start_app(conf):
+    """Приложение на случайном порту в этом же процессе; возвращает (runner, base_url)"""
+    from aiohttp import web
+    from main import create_app
+
+    runner = web.AppRunner(create_app(conf))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+async def login_load(args):
+    login = {'login': args.login, 'password': args.password}
+    runner = None
+    url = args.url
+    if url is None:
+        conf = bench_config(args.keep_login_limits)
+        login_limits = conf['login_limits']
+        runner, url = await start_app(conf)
+    else:
+        login_limits = 'server'
+
+    login_statuses = collections.Counter()
+    try:
+        async with aiohttp.ClientSession() as session:
+            idle = await measure_index(session, url, args.duration, args.index_concurrency)
+
+            login_workers = [
+                lambda deadline: hammer(session, 'POST', url + '/login', deadline,
+                                        statuses=login_statuses, json=login)
+                for _ in range(args.login_concurrency)
+            ]
+            loaded = await measure_index(session, url, args.duration, args.index_concurrency, login_workers)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+    return {
+        'meta': {
+            'url': args.url,
+            'login_limits': login_limits,
+            'login_statuses': {str(status): count for status, count in sorted(login_statuses.items())},
+        },
+        'index_idle': idle,
+        'index_under_logins': loaded,
+    }
+
+
+def build_routes(user_count):
+    """Генераторы n-го запроса для каждого маршрута
+
+    После заполнения базы admin имеет id 1, user - id 2, синтетические пользователи
+    userN - id от 3 до user_count + 2.
+    """
+    run_id = os.getpid()
+
+    def synthetic_id(n):
+        return n % user_count + 3
+
+    return {
+        'index': lambda n: ('GET', '/', {}),
+        'detail': lambda n: ('GET', f'/detail/{synthetic_id(n)}', {}),
+        'user': lambda n: ('GET', '/user', {}),
+        'login': lambda n: ('POST', '/login', {'json': {'login': 'user', 'password': 'user'}}),
+        'create': lambda n: ('POST', '/create', {'json': {'login': f'bench-{run_id}-{n}', 'password': 'bench'}}),
+        'edit': lambda n: ('POST', f'/edit/{synthetic_id(n)}',
+                           {'json': {'login': f'user{synthetic_id(n)}', 'first_name': f'bench{n}'}}),
+        'delete': lambda n: ('DELETE', f'/delete/{user_count + 2 - n % user_count}', {}),
+    }
+
+
+async def drive(session, base_url, make_request, total, concurrency):
+    """Отправка total запросов маршрута с фиксированным числом параллельных клиентов"""
+    counter = itertools.count()
+    latencies = []
+    statuses = collections.Counter()
+
+    async def worker():
+        for n in counter:
+            if n >= total:
+                return
+            method, path, kwargs = make_request(n)
+            started = time.monotonic()
+            async with session.request(method, base_url + path, **kwargs) as resp:
+                await resp.read()
+            latencies.append(time.monotonic() - started)
+            statuses[resp.status] += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summary(latencies, time.monotonic() - started)
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items())}
+    return result
+
+
+async def measure_allocations(session, base_url, make_request, start, samples):
+    """Средний пик выделенной памяти на запрос (KiB), клиент и сервер в одном процессе
+
+    Трассировка перезапускается на каждый запрос: так пик сбрасывается и на Python 3.8,
+    где нет tracemalloc.reset_peak.
+    """
+    peaks = []
+    for n in range(start, start + samples):
+        method, path, kwargs = make_request(n)
+        tracemalloc.start()
+        try:
+            async with session.request(method, base_url + path, **kwargs) as resp:
+                await resp.read()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return round(sum(peaks) / len(peaks) / 1024, 2) if peaks else 0.0
+
+
+def seed_database(user_count):
+    import init_db
+
+    engine = init_db.get_engine()
+    init_db.create_tables(engine)
+    init_db.sample_data(engine)
+    init_db.generate_users(engine, user_count, seed=0)
+
+
+async def run_routes(args):
+    conf = bench_config(args.keep_login_limits)
+    runner, base_url = await start_app(conf)
+
+    routes = build_routes(args.users)
+    selected = args.route or list(routes)
+    results = {}
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as admin, aiohttp.ClientSession() as anonymous:
+            async with admin.post(base_url + '/login', json={'login': 'admin', 'password': 'admin'}) as resp:
+                resp.raise_for_status()
+
+            for name in selected:
+                session = anonymous if name == 'login' else admin
+                result = await drive(session, base_url, routes[name], args.requests, args.concurrency)
+                result['peak_alloc_kib_per_request'] = await measure_allocations(
+                    session, base_url, routes[name], args.requests, args.alloc_samples)
+                results[name] = result
+    finally:
+        await runner.cleanup()
+
+    return {
+        'meta': {
+            'users': args.users,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'login_limits': conf['login_limits'],
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'routes': results,
+    }
+
+
+def build_repository_ops(user_count):
+    """Операции репозитория для сравнения драйверов; пользователи userN имеют id от 3 до user_count + 2"""
+    rnd = random.Random(0)
+
+    def user_id():
+        return rnd.randrange(3, user_count + 3)
+
+    return {
+        'list': lambda repo: repo.list_users(user_id(), 100),
+        'detail': lambda repo: repo.get_user(user_id()),
+        'auth': lambda repo: repo.get_auth_info(f'user{user_id()}'),
+        'credentials': lambda repo: repo.get_password(f'user{user_id()}'),
+    }
+
+
+async def run_backends(args):
+    import db
+    from repository import create_repository
+    from settings import config
+
+    results = {}
+    for backend in ('aiopg', 'asyncpg'):
+        conf = copy.deepcopy(config)
+        conf['storage']['backend'] = backend
+        engine = await db.create_engine(conf['postgres'])
+        repo = await create_repository(conf, engine)
+        try:
+            results[backend] = {}
+            for name, op in build_repository_ops(args.users).items():
+                counter = itertools.count()
+                latencies = []
+
+                async def worker():
+                    while next(counter) < args.requests:
+                        started = time.monotonic()
+                        await op(repo)
+                        latencies.append(time.monotonic() - started)
+
+                started = time.monotonic()
+                await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+                results[backend][name] = summary(latencies, time.monotonic() - started)
+        finally:
+            await repo.close()
+            engine.close()
+            await engine.wait_closed()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Сравнение с сохраненным базовым замером, возвращает список регрессий"""
+    regressions = []
+    for name, current in results['routes'].items():
+        previous = baseline['routes'].get(name)
+        if not previous:
+            continue
+        if current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: rps {previous['rps']} -> {current['rps']}")
+        if current['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {previous['p99_ms']}ms -> {current['p99_ms']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    login_parser = subparsers.add_parser('login-load', help='p99 GET / while logins hammer the server')
+    login_parser.add_argument('--url', help='адрес запущенного сервера (по умолчанию приложение в этом процессе)')
+    login_parser.add_argument('--duration', type=float, default=10)
+    login_parser.add_argument('--index-concurrency', type=int, default=4)
+    login_parser.add_argument('--login-concurrency', type=int, default=32)
+    login_parser.add_argument('--login', default='user')
+    login_parser.add_argument('--password', default='user')
+    login_parser.add_argument('--keep-login-limits', action='store_true',
+                              help='не заменять ограничения входа на BENCH_LOGIN_LIMITS')
+
+    routes_parser = subparsers.add_parser('routes', help='req/s, latency and allocations for every route')
+    routes_parser.add_argument('--route', action='append', choices=list(build_routes(1)),
+                               help='маршрут для замера, можно указать несколько раз (по умолчанию все)')
+    routes_parser.add_argument('--seed', action='store_true', help='пересоздать таблицы и заполнить базу')
+    routes_parser.add_argument('--users', type=int, default=10000)
+    routes_parser.add_argument('--requests', type=int, default=2000)
+    routes_parser.add_argument('--concurrency', type=int, default=16)
+    routes_parser.add_argument('--alloc-samples', type=int, default=50)
+    routes_parser.add_argument('--keep-login-limits', action='store_true',
+                               help='не заменять ограничения входа на BENCH_LOGIN_LIMITS')
+    routes_parser.add_argument('--output', help='файл для результатов в JSON')
+    routes_parser.add_argument('--baseline', help='файл базового замера для сравнения')
+    routes_parser.add_argument('--tolerance', type=float, default=0.1,
+                               help='допустимое ухудшение rps и p99 относительно базового замера')
+
+    backends_parser = subparsers.add_parser('backends', help='aiopg vs asyncpg on the fixed repository queries')
+    backends_parser.add_argument('--users', type=int, default=10000)
+    backends_parser.add_argument('--requests', type=int, default=5000)
+    backends_parser.add_argument('--concurrency', type=int, default=16)
+
+    args = parser.parse_args()
+    regressions = []
+    if args.command == 'login-load':
+        result = asyncio.run(login_load(args))
+    elif args.command == 'backends':
+        result = asyncio.run(run_backends(args))
+    elif args.command == 'routes':
+        if args.seed:
+            seed_database(args.users)
+        result = asyncio.run(run_routes(args))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(result, json.load(f), args.tolerance)
+    print(json.dumps(result, indent=2))
+
+    for regression in regressions:
+        print('REGRESSION', regression, file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import asyncio
+
+from marshmallow import ValidationError
+from sqlalchemy.dialects.postgresql import insert
+
+import db
+from schemas import BulkUserSchema
+from serializers import loads
+
+
+bulk_user_schema = BulkUserSchema()
+
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+class BodyTooLarge(ValueError):
+    """JSON-массив больше bulk.max_json_size"""
+
+
+async def read_body(request, max_size: int) -> bytes:
+    """Тело запроса с собственным ограничением размера вместо client_max_size приложения (1 МиБ)"""
+    body = bytearray()
+    async for chunk in request.content.iter_chunked(BODY_CHUNK_SIZE):
+        body.extend(chunk)
+        if len(body) > max_size:
+            raise BodyTooLarge(f'JSON array is larger than {max_size} bytes, use application/x-ndjson')
+    return bytes(body)
+
+# во всех строках многострочного VALUES должен быть одинаковый набор колонок
+USER_DEFAULTS = {'first_name': None, 'last_name': None, 'birthday': None, 'disabled': False}
+
+
+async def iter_bulk_rows(request, max_json_size: int):
+    """Чтение строк массового создания из JSON-массива или NDJSON-потока
+
+    NDJSON читается построчно, без загрузки всего тела в память; вместо строки с невалидным
+    JSON возвращается ошибка разбора, чтобы она попала в результат этой строки.
+    JSON-массив читается целиком, не больше max_json_size байт.
+    """
+    if request.content_type == 'application/x-ndjson':
+        async for line in request.content:
+            line = line.strip()
+            if line:
+                try:
+                    yield loads(line)
+                except ValueError as e:
+                    yield e
+    else:
+        rows = loads(await read_body(request, max_json_size))
+        if not isinstance(rows, list):
+            raise ValueError('Expected a JSON array of users')
+        for row in rows:
+            yield row
+
+
+async def _insert_batch(conn, batch):
+    """Вставка пачки пользователей одним INSERT ... RETURNING вместе с правами"""
+    query = insert(db.users) \
+        .values([dict(USER_DEFAULTS, **data) for _, data, _ in batch]) \
+        .on_conflict_do_nothing(index_elements=[db.users.c.login]) \
+        .returning(db.users.c.id, db.users.c.login)
+    cursor = await conn.execute(query)
+    created = {row.login: row.id for row in await cursor.fetchall()}
+
+    results = {}
+    permissions = []
+    for index, data, role in batch:
+        user_id = created.pop(data['login'], None)
+        if user_id is None:
+            results[index] = {'index': index, 'error': 'User with this login already exists'}
+            continue
+        results[index] = {'index': index, 'id': user_id, 'login': data['login']}
+        if role:
+            permissions.append({'users_id': user_id, 'role': role})
+
+    if permissions:
+        await conn.execute(db.permissions.insert().values(permissions))
+    return results
+
+
+async def insert_batch(conn, batch):
+    """Вставка пачки в savepoint; при ошибке пачка повторяется построчно,
+    чтобы ошибка одной строки не отменяла остальные"""
+    try:
+        async with conn.begin_nested():
+            return await _insert_batch(conn, batch)
+    except db.StatementTimeout:
+        raise
+    except Exception as e:
+        if len(batch) == 1:
+            index = batch[0][0]
+            return {index: {'index': index, 'error': str(e)}}
+
+    results = {}
+    for item in batch:
+        results.update(await insert_batch(conn, [item]))
+    return results
+
+
+async def create_users(engine, hasher, rows, batch_size: int, max_rows: int):
+    """Массовое создание пользователей пачками
+
+    Пачка разбирается, проверяется и хешируется до получения соединения из пула; соединение
+    и транзакция удерживаются только на время вставки пачки. Строки сверх max_rows не читаются.
+    Возвращает список результатов по каждой строке: id созданного пользователя или ошибку.
+    """
+    results = []
+
+    async def flush(batch):
+        hashes = await asyncio.gather(*(hasher.hash(data['password']) for _, data, _ in batch))
+        for (_, data, _), hashed in zip(batch, hashes):
+            data['password'] = hashed
+        async with engine.acquire() as conn:
+            async with conn.begin():
+                batch_results = await insert_batch(conn, batch)
+        results.extend(batch_results[index] for index, _, _ in batch)
+
+    batch = []
+    index = 0
+    async for row in rows:
+        if index >= max_rows:
+            results.append({'index': index, 'error': f'Too many rows, the limit is {max_rows}'})
+            break
+        try:
+            if isinstance(row, ValueError):
+                raise ValidationError(str(row))
+            data = bulk_user_schema.load(row)
+        except ValidationError as e:
+            results.append({'index': index, 'error': e.messages})
+        else:
+            role = data.pop('role', None)
+            batch.append((index, data, role))
+        index += 1
+
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+    results.sort(key=lambda result: result['index'])
+    return results
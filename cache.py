@@ -0,0 +1,133 @@
+import time
+from collections import OrderedDict
+from typing import Union
+
+
+MISSING = object()
+
+
+class TTLCache(object):
+    """LRU-кэш ограниченного размера с временем жизни записей
+
+    index(value) - необязательный вторичный ключ значения (или None): по нему записи
+    сбрасываются за постоянное время, без просмотра всего кэша.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, index=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.index = index
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._index = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def _unindex(self, key, value):
+        secondary = self.index(value) if self.index is not None else None
+        if secondary is not None:
+            keys = self._index.get(secondary)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[secondary]
+
+    def _remove(self, key):
+        item = self._data.pop(key, MISSING)
+        if item is not MISSING:
+            self._unindex(key, item[1])
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key, MISSING)
+        if item is not MISSING:
+            expires, value = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._remove(key)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        secondary = self.index(value) if self.index is not None else None
+        if secondary is not None:
+            self._index.setdefault(secondary, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)))
+
+    def invalidate(self, key):
+        self._remove(key)
+
+    def invalidate_indexed(self, secondary):
+        """Удаление записей с вторичным ключом secondary"""
+        for key in self._index.pop(secondary, ()):
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._index.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class TableVersions(object):
+    """Версии таблиц для ETag - id последнего события журнала изменений user_events
+
+    Версия любой таблицы - id последнего события журнала вообще, какой бы таблицы оно ни
+    касалось: то же значение дает max(id) журнала (refresh), поэтому ETag совпадает во всех
+    рабочих процессах и после перезапуска. Версии ведутся по событиям ленты (start, advance).
+    Пока лента выключена, а также после записи в текущем процессе (bump), пока не перечитан
+    журнал, версия таблицы неизвестна: get возвращает None, и ее нужно взять из базы (refresh).
+    """
+
+    def __init__(self):
+        self.tracking = False
+        self.generation = 0
+        self.last_event = 0
+        self._versions = {}
+
+    def get(self, table: str) -> Union[int, None]:
+        if not self.tracking:
+            return None
+        return self._versions.get(table)
+
+    def start(self, last_event: int, *tables: str):
+        """Начало учета версий по ленте изменений с последнего события журнала"""
+        self.tracking = True
+        self.last_event = last_event
+        for table in tables:
+            self._versions[table] = last_event
+
+    def advance(self, event_id: int):
+        """Событие ленты изменений; неизвестные версии остаются неизвестными до refresh"""
+        self.last_event = max(self.last_event, event_id)
+        for table, version in self._versions.items():
+            self._versions[table] = max(version, event_id)
+
+    def bump(self, *tables: str):
+        """Запись в текущем процессе: событие о ней может прийти позже следующего чтения"""
+        self.generation += 1
+        for table in tables:
+            self._versions.pop(table, None)
+
+    def refresh(self, table: str, latest: int, generation: int) -> int:
+        """Версия таблицы по последнему id журнала, прочитанному из базы
+
+        События, пришедшие во время чтения, учитываются через last_event; версия запоминается,
+        только если с начала чтения (generation) в процессе не было записей.
+        """
+        version = max(latest, self.last_event)
+        if self.tracking and generation == self.generation:
+            self._versions[table] = version
+        return version
+
+    @staticmethod
+    def etag(version: int) -> str:
+        return f'"{version}"'
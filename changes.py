@@ -0,0 +1,194 @@
+import asyncio
+import datetime
+import logging
+from contextlib import contextmanager
+from functools import partial
+
+import aiopg
+import sqlalchemy as sa
+
+import db
+from serializers import dumps, loads
+
+
+logger = logging.getLogger(__name__)
+
+PRUNE_INTERVAL = 3600
+
+
+def format_event(event: dict) -> bytes:
+    """Событие в формате server-sent events"""
+    return b'id: %d\ndata: %s\n\n' % (event['id'], dumps(event))
+
+
+def latest_id_query():
+    return sa.select([sa.func.coalesce(sa.func.max(db.user_events.c.id), 0)])
+
+
+def first_id_query():
+    return sa.select([sa.func.min(db.user_events.c.id)])
+
+
+def history_query(after: int, limit: int):
+    return db.user_events.select() \
+        .where(db.user_events.c.id > after) \
+        .order_by(db.user_events.c.id) \
+        .limit(limit)
+
+
+def _event(row) -> dict:
+    return {'id': row.id, 'table': row.table_name, 'op': row.op, 'user_id': row.user_id, 'login': row.login}
+
+
+class ChangeFeed(object):
+    """Рассылка событий изменения пользователей и прав подписчикам процесса
+
+    События пишутся триггерами в журнал user_events и приходят через одно соединение
+    LISTEN на процесс. После переподключения пропущенные события дочитываются из журнала.
+    Подписчик, не успевающий разбирать очередь, отключается и после переподключения
+    с Last-Event-ID догоняет по журналу.
+    """
+
+    def __init__(self, engine, connect, queue_size: int, history_batch: int):
+        self.engine = engine
+        self.connect = connect
+        self.queue_size = queue_size
+        self.history_batch = history_batch
+        self.last_id = 0
+        self.subscribers = set()
+        self.callbacks = []
+
+    @contextmanager
+    def subscribe(self):
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self.subscribers.discard(queue)
+
+    def _disconnect(self, queue):
+        self.subscribers.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def publish(self, event: dict):
+        if event['id'] <= self.last_id:
+            return
+        self.last_id = event['id']
+        for callback in self.callbacks:
+            callback(event)
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._disconnect(queue)
+
+    def close(self):
+        for queue in list(self.subscribers):
+            self._disconnect(queue)
+
+    async def latest_id(self) -> int:
+        async with self.engine.acquire() as conn:
+            return await conn.scalar(latest_id_query())
+
+    async def missed(self, after: int) -> bool:
+        """Часть событий после after уже удалена из журнала"""
+        async with self.engine.acquire() as conn:
+            first = await conn.scalar(first_id_query())
+        return first is not None and after < first - 1
+
+    async def history(self, after: int) -> list:
+        """Очередная пачка событий журнала после after"""
+        async with self.engine.acquire() as conn:
+            cursor = await conn.execute(history_query(after, self.history_batch))
+            return [_event(row) for row in await cursor.fetchall()]
+
+    async def catch_up(self):
+        while True:
+            events = await self.history(self.last_id)
+            for event in events:
+                self.publish(event)
+            if len(events) < self.history_batch:
+                break
+
+    async def listen(self, keepalive: float, reconnect_delay: float):
+        """Прием уведомлений; соединение проверяется, если уведомлений нет дольше keepalive"""
+        while True:
+            try:
+                async with self.connect() as conn:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(f'LISTEN {db.CHANGE_FEED_CHANNEL}')
+                        await self.catch_up()
+                        while True:
+                            try:
+                                notify = await asyncio.wait_for(conn.notifies.get(), keepalive)
+                            except asyncio.TimeoutError:
+                                await cursor.execute('SELECT 1')
+                                continue
+                            self.publish(loads(notify.payload))
+            except Exception:
+                logger.exception('Change feed listener failed, reconnecting')
+                await asyncio.sleep(reconnect_delay)
+
+    async def prune(self, retention_days: int):
+        """Удаление старых событий журнала; последнее событие остается для проверки missed"""
+        c = db.user_events.c
+        latest = sa.select([sa.func.max(c.id)]).as_scalar()
+        query = db.user_events.delete().where(sa.and_(
+            c.created_at < sa.func.now() - datetime.timedelta(days=retention_days),
+            c.id < latest,
+        ))
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            try:
+                async with self.engine.acquire() as conn:
+                    await conn.execute(query)
+            except Exception:
+                logger.exception('Change feed prune failed')
+
+
+def apply_event(app, event: dict):
+    """Сброс кэшей процесса после изменений, сделанных в том числе другими процессами
+
+    Версии таблиц сдвигаются на каждом событии журнала, чтобы совпадать с max(id) журнала.
+    """
+    app['versions'].advance(event['id'])
+    if event['op'] == 'logout':
+        # данные не менялись; сессии отменяет политика токенов, если она включена
+        logout = getattr(app['identity_policy'], 'logout', None)
+        if logout is not None:
+            logout(event['user_id'])
+        return
+    if event['op'] == 'reload':
+        app['authz_policy'].invalidate_all()
+        return
+    app['authz_policy'].invalidate(login=event['login'], user_id=event['user_id'])
+
+
+async def init_change_feed(app):
+    conf = app['config']['change_feed']
+    if not conf['enabled']:
+        return
+
+    postgres = app['config']['postgres']
+    feed = ChangeFeed(app.db_engine, partial(aiopg.connect, **db.connection_params(postgres)),
+                      conf['queue_size'], conf['history_batch'])
+    feed.last_id = await feed.latest_id()
+    app['versions'].start(feed.last_id, 'users', 'permissions')
+    feed.callbacks.append(partial(apply_event, app))
+    app['change_feed'] = feed
+    app['change_feed_tasks'] = [
+        asyncio.ensure_future(feed.listen(conf['keepalive'], conf['reconnect_delay'])),
+        asyncio.ensure_future(feed.prune(conf['retention_days'])),
+    ]
+
+
+async def close_change_feed(app):
+    """on_shutdown: открытые потоки событий завершаются до ожидания обработчиков"""
+    if 'change_feed' not in app:
+        return
+    for task in app['change_feed_tasks']:
+        task.cancel()
+    app['change_feed'].close()
@@ -0,0 +1,208 @@
+import asyncio
+import time
+import zlib
+from functools import partial
+from typing import Union
+
+from aiohttp import hdrs, web
+
+from metrics import record_span
+
+
+class _GzipCompressor(object):
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliCompressor(object):
+    def __init__(self, brotli, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdCompressor(object):
+    def __init__(self, zstandard, level: int):
+        self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_mode)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def available_compressors() -> dict:
+    """Компрессоры по кодировкам; brotli и zstandard необязательны (без них доступен только gzip)
+    и импортируются только при включенном сжатии"""
+    compressors = {'gzip': _GzipCompressor}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        compressors['br'] = partial(_BrotliCompressor, brotli)
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        compressors['zstd'] = partial(_ZstdCompressor, zstandard)
+    return compressors
+
+
+def negotiate(accept_encoding: str, encodings) -> Union[str, None]:
+    """Кодировка из Accept-Encoding с наибольшим q; при равном q - первая из encodings"""
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def _add_vary(headers):
+    vary = headers.get(hdrs.VARY)
+    if vary is None:
+        headers[hdrs.VARY] = hdrs.ACCEPT_ENCODING
+    elif 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+        headers[hdrs.VARY] = f'{vary}, {hdrs.ACCEPT_ENCODING}'
+
+
+def _mark_encoded(response, encoding: str):
+    """Заголовки сжатого ответа; сильный ETag становится слабым, как у сжимающих прокси"""
+    response.headers[hdrs.CONTENT_ENCODING] = encoding
+    response.headers.pop(hdrs.CONTENT_LENGTH, None)
+    etag = response.headers.get(hdrs.ETAG)
+    if etag and not etag.startswith('W/'):
+        response.headers[hdrs.ETAG] = 'W/' + etag
+
+
+def _compress_all(compressor, data: bytes) -> bytes:
+    return compressor.compress(data) + compressor.finish()
+
+
+class Compression(object):
+    """Сжатие ответов по Accept-Encoding
+
+    Сжимаются ответы с типами из compression.types; готовые тела - от min_size байт.
+    Части больше executor_min_size сжимаются в пуле потоков: zlib, brotli и zstandard
+    освобождают GIL, и event loop не блокируется.
+    """
+
+    def __init__(self, conf: dict):
+        self.compressors = available_compressors()
+        self.encodings = [encoding for encoding in conf['encodings'] if encoding in self.compressors]
+        self.levels = conf['levels']
+        self.min_size = conf['min_size']
+        self.executor_min_size = conf['executor_min_size']
+        self.types = set(conf['types'])
+
+    def eligible(self, response) -> bool:
+        return (200 <= response.status and response.status not in (204, 304)
+                and hdrs.CONTENT_ENCODING not in response.headers
+                and response.content_type in self.types)
+
+    def compressor(self, request):
+        """(кодировка, компрессор) по Accept-Encoding запроса или (None, None)"""
+        encoding = negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ''), self.encodings)
+        if encoding is None:
+            return None, None
+        return encoding, self.compressors[encoding](self.levels[encoding])
+
+    async def run(self, func, *args) -> bytes:
+        started = time.perf_counter()
+        try:
+            if len(args[-1]) >= self.executor_min_size:
+                return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+            return func(*args)
+        finally:
+            record_span('compress', time.perf_counter() - started)
+
+    async def compress_response(self, request, response: web.Response):
+        body = response.body
+        if not isinstance(body, (bytes, bytearray)) or len(body) < self.min_size or not self.eligible(response):
+            return
+        _add_vary(response.headers)
+        encoding, compressor = self.compressor(request)
+        if compressor is None:
+            return
+        response.body = await self.run(_compress_all, compressor, body)
+        _mark_encoded(response, encoding)
+
+
+class CompressedStreamResponse(web.StreamResponse):
+    """Потоковый ответ со сжатием на лету
+
+    Каждая записанная часть сжимается и сбрасывается клиенту сразу (sync flush), тело целиком
+    не накапливается. Для server-sent events не используется: там важна задержка, а не объем.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._settings = None
+        self._compressor = None
+
+    async def prepare(self, request):
+        compression = request.app.get('compression')
+        if not self.prepared and compression is not None and compression.eligible(self):
+            _add_vary(self.headers)
+            encoding, self._compressor = compression.compressor(request)
+            if self._compressor is not None:
+                self._settings = compression
+                _mark_encoded(self, encoding)
+        return await super().prepare(request)
+
+    async def write(self, data):
+        if self._compressor is not None:
+            data = await self._settings.run(self._compressor.compress, data)
+            if not data:
+                return
+        await super().write(data)
+
+    async def write_eof(self, data=b''):
+        if self._compressor is not None:
+            data = await self._settings.run(_compress_all, self._compressor, data)
+            self._compressor = None
+        await super().write_eof(data)
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """Сжатие готовых (не потоковых) ответов"""
+    response = await handler(request)
+    if isinstance(response, web.Response) and not response.prepared:
+        await request.app['compression'].compress_response(request, response)
+    return response
+
+
+def setup_compression(app):
+    conf = app['config']['compression']
+    if not conf['enabled']:
+        return
+    app['compression'] = Compression(conf)
+    app.middlewares.append(compression_middleware)
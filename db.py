@@ -1,13 +1,25 @@
+import asyncio
+import contextvars
 import enum
 import os
+import time
+import weakref
 
 import aiopg.sa
-from sqlalchemy import MetaData, Table, Column, Integer, String, Boolean, ForeignKey, Date
-from sqlalchemy_utils import ChoiceType
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, String, Boolean, ForeignKey, Date, DateTime, \
+    DDL, event, func
+from sqlalchemy.types import TypeDecorator
 
+from aiohttp import web
 from aiohttp_security import setup as setup_security, CookiesIdentityPolicy
 
-from db_auth import DBAuthorizationPolicy
+import repository
+from cache import TTLCache
+from db_auth import DBAuthorizationPolicy, auth_info_user_id
+from metrics import POOL_ACQUIRE_WAIT, QUERY_DURATION, record_span
+from replicas import ReadRouter, Replica, has_replicas
+from serializers import json_error, json_response
+from tokens import create_token_policy
 
 TYPES = [
     ('admin', 'Admin'),
@@ -20,6 +32,22 @@ class PermEnum(enum.Enum):
     READONLY = 'readonly'
 
 
+class EnumString(TypeDecorator):
+    """Перечисление, хранящееся строкой значения; совместимо с ChoiceType из sqlalchemy_utils,
+    импорт которого заметно замедляет запуск"""
+    impl = String
+
+    def __init__(self, enum_class, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.enum_class = enum_class
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else self.enum_class(value).value
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.enum_class(value)
+
+
 meta = MetaData()
 
 
@@ -32,38 +60,367 @@ users = Table(
     Column('first_name', String(128)),
     Column('last_name', String(128)),
     Column('birthday', Date, nullable=True),
-    Column('disabled', Boolean, nullable=False, default=False)
+    Column('disabled', Boolean, nullable=False, default=False),
+    # номер версии строки для If-Match, увеличивается при каждом редактировании
+    Column('version', Integer, nullable=False, server_default='1')
 )
 
+# индексы для поиска пользователей, те же, что в миграции 3c9d4e1f2a7b_search_indexes
+SEARCH_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX ix_users_lower_login ON users (lower(login) text_pattern_ops)',
+    'CREATE INDEX ix_users_first_name_trgm ON users USING gin (first_name gin_trgm_ops)',
+    'CREATE INDEX ix_users_last_name_trgm ON users USING gin (last_name gin_trgm_ops)',
+    'CREATE INDEX ix_users_birthday ON users (birthday)',
+    'CREATE INDEX ix_users_active_id ON users (id) INCLUDE (login, first_name, last_name) WHERE NOT disabled',
+]
+for statement in SEARCH_INDEXES:
+    event.listen(users, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
 permissions = Table(
     'permissions', meta,
 
     Column('id', Integer, primary_key=True),
     Column('users_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), unique=True),
-    Column('role', ChoiceType(PermEnum, impl=String()), nullable=False, default=PermEnum.READONLY.value),
+    Column('role', EnumString(PermEnum), nullable=False, default=PermEnum.READONLY.value),
     Column('blocking', Boolean, default=False)
 )
 
 
-async def init_pg(app):
-    conf = app['config']['postgres']
+# журнал изменений users и permissions для ленты изменений (changes.py)
+user_events = Table(
+    'user_events', meta,
+
+    Column('id', BigInteger, primary_key=True),
+    Column('table_name', String(32), nullable=False),
+    Column('op', String(16), nullable=False),
+    Column('user_id', Integer),
+    Column('login', String(128)),
+    Column('created_at', DateTime(timezone=True), nullable=False, server_default=func.now())
+)
+
+CHANGE_FEED_CHANNEL = 'user_events'
+
+# событие массовой загрузки (init_db.py generate/import): триггеры на время загрузки отключены,
+# вместо события на строку пишется одно, после которого сбрасываются все кэши
+RELOAD_EVENT = f"""WITH event AS (
+    INSERT INTO user_events (table_name, op) VALUES (%s, 'reload') RETURNING id, table_name, op
+)
+SELECT pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object(
+    'id', id, 'table', table_name, 'op', op, 'user_id', NULL, 'login', NULL)::text)
+FROM event"""
+
+# выход пользователя: по событию все процессы отменяют его сессии (tokens.TokenIdentityPolicy.logout)
+LOGOUT_EVENT = f"""WITH event AS (
+    INSERT INTO user_events (table_name, op, user_id, login) VALUES ('users', 'logout', %s, %s)
+    RETURNING id, table_name, op, user_id, login
+)
+SELECT pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object(
+    'id', id, 'table', table_name, 'op', op, 'user_id', user_id, 'login', login)::text)
+FROM event"""
+
+# функция и триггеры ленты изменений, те же, что в миграции 5d1e7a9c3b20_change_feed
+# триггеры отложены до фиксации (миграция 9e2a6c4d8f31): advisory lock упорядочивает фиксации
+# пишущих транзакций, поэтому id событий растут в порядке фиксации, а блокировка держится
+# только на время COMMIT, а не всю транзакцию
+NOTIFY_FUNCTION = f"""CREATE OR REPLACE FUNCTION notify_user_event() RETURNS trigger AS $$
+DECLARE
+    changed record;
+    event_op text;
+    event_id bigint;
+    event_user_id integer;
+    event_login text;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('{CHANGE_FEED_CHANNEL}'));
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+        event_op := 'delete';
+    ELSIF TG_OP = 'INSERT' THEN
+        changed := NEW;
+        event_op := 'create';
+    ELSE
+        changed := NEW;
+        event_op := 'edit';
+    END IF;
+
+    IF TG_TABLE_NAME = 'users' THEN
+        event_user_id := changed.id;
+        event_login := changed.login;
+        IF TG_OP = 'UPDATE' THEN
+            IF NEW.disabled AND NOT OLD.disabled THEN
+                event_op := 'disable';
+            ELSIF OLD.disabled AND NOT NEW.disabled THEN
+                event_op := 'enable';
+            END IF;
+        END IF;
+    ELSE
+        event_user_id := changed.users_id;
+    END IF;
+
+    INSERT INTO user_events (table_name, op, user_id, login)
+    VALUES (TG_TABLE_NAME, event_op, event_user_id, event_login)
+    RETURNING id INTO event_id;
+    PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object(
+        'id', event_id, 'table', TG_TABLE_NAME, 'op', event_op,
+        'user_id', event_user_id, 'login', event_login)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql"""
+
+for table in (users, permissions):
+    event.listen(table, 'after_create', DDL(NOTIFY_FUNCTION).execute_if(dialect='postgresql'))
+    event.listen(table, 'after_create', DDL(
+        f'CREATE CONSTRAINT TRIGGER {table.name}_notify AFTER INSERT OR UPDATE OR DELETE ON {table.name} '
+        'DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE PROCEDURE notify_user_event()'
+    ).execute_if(dialect='postgresql'))
+
+
+def statement_type(query) -> str:
+    if isinstance(query, str):
+        return query.split(None, 1)[0].lower()
+    return getattr(query, '__visit_name__', 'other')
+
+
+# statement_timeout (мс) для соединений, выдаваемых в текущем запросе; None - значение по умолчанию
+STATEMENT_TIMEOUT = contextvars.ContextVar('statement_timeout', default=None)
+
+
+class StatementTimeout(Exception):
+    """Запрос отменен сервером по statement_timeout"""
+
+    def __init__(self, message='canceling statement due to statement timeout'):
+        super().__init__(message)
+
+
+async def _cancellable(conn, coro):
+    """Выполнение запроса с отменой на сервере при отмене задачи запроса
+
+    aiopg при отмене закрывает соединение, а запрос продолжает выполняться на сервере.
+    Здесь запрос выполняется в отдельной задаче: при отмене отправляется cancel (PQcancel),
+    сервер прерывает запрос, и соединение возвращается в пул исправным.
+    aiopg превращает прерванный сервером запрос в CancelledError; если отменена не задача
+    запроса, а сам запрос (statement_timeout), выбрасывается StatementTimeout.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            raise StatementTimeout() from None
+        if not task.done():
+            await asyncio.get_running_loop().run_in_executor(None, conn.connection.raw.cancel)
+            await asyncio.wait([task])
+        raise
+
+
+class MeteredConnection(object):
+    """Соединение с учетом времени выполнения запросов по типу выражения"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def execute(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await _cancellable(self._conn, self._conn.execute(query, *args, **kwargs))
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_DURATION.observe(elapsed, statement_type(query))
+            record_span('sql', elapsed)
+
+    async def scalar(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await _cancellable(self._conn, self._conn.scalar(query, *args, **kwargs))
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_DURATION.observe(elapsed, statement_type(query))
+            record_span('sql', elapsed)
+
+
+class _MeteredAcquire(object):
+    __slots__ = ('_engine', '_conn')
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._conn = None
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        self._conn = await self._engine.raw.acquire()
+        elapsed = time.perf_counter() - started
+        POOL_ACQUIRE_WAIT.observe(elapsed)
+        record_span('acquire', elapsed)
+        try:
+            await self._engine.apply_timeout(self._conn)
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
+        return MeteredConnection(self._conn)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._conn.close()
+        self._conn = None
+
+
+class MeteredEngine(object):
+    """Обертка над aiopg engine с учетом ожидания соединения из пула
+
+    При выдаче соединения устанавливается statement_timeout маршрута (STATEMENT_TIMEOUT)
+    или statement_timeout по умолчанию; SET выполняется, только если значение на соединении другое.
+    """
+
+    def __init__(self, engine, statement_timeout: int = 0):
+        self.raw = engine
+        self.statement_timeout = statement_timeout
+        self._timeouts = weakref.WeakKeyDictionary()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def acquire(self):
+        return _MeteredAcquire(self)
+
+    async def apply_timeout(self, conn):
+        timeout = STATEMENT_TIMEOUT.get()
+        if timeout is None:
+            timeout = self.statement_timeout
+        raw = conn.connection
+        if self._timeouts.get(raw) != timeout:
+            await conn.execute(f'SET statement_timeout = {int(timeout)}')
+            self._timeouts[raw] = timeout
+
+    async def prewarm(self, count: int):
+        """Открытие count соединений пула заранее, с установкой statement_timeout"""
+        acquires = [self.acquire() for _ in range(count)]
+        results = await asyncio.gather(*(acquire.__aenter__() for acquire in acquires), return_exceptions=True)
+        for acquire, result in zip(acquires, results):
+            if not isinstance(result, BaseException):
+                await acquire.__aexit__(None, None, None)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+def connection_params(conf) -> dict:
+    return {
+        'database': conf['database'],
+        'user': conf['user'],
+        'password': conf['password'],
+        'host': os.environ.get('POSTGRES_HOST', conf['host']),
+        'port': conf['port'],
+    }
+
+
+async def create_engine(conf, statement_timeout: int = 0):
     engine = await aiopg.sa.create_engine(
-        database=conf['database'],
-        user=conf['user'],
-        password=conf['password'],
-        host=os.environ.get('POSTGRES_HOST', conf['host']),
-        port=conf['port'],
         minsize=conf['minsize'],
         maxsize=conf['maxsize'],
+        **connection_params(conf)
     )
+    return MeteredEngine(engine, statement_timeout)
+
+
+async def create_read_engine(app, engine):
+    """Engine для чтения: реплики из replicas.dsns или основной сервер, если реплик нет
+
+    Пулы реплик открывают соединения по мере надобности, поэтому недоступная при старте
+    реплика не мешает запуску: первая проверка исключает ее до выздоровления.
+    """
+    conf = app['config']['replicas']
+    if not conf['dsns']:
+        return engine
+
+    postgres = app['config']['postgres']
+    replicas = []
+    for number, dsn in enumerate(conf['dsns']):
+        replica_engine = await aiopg.sa.create_engine(dsn, minsize=0, maxsize=postgres['maxsize'])
+        replicas.append(Replica(f'replica{number}', MeteredEngine(replica_engine, engine.statement_timeout)))
+
+    router = ReadRouter(engine, replicas, conf['strategy'], postgres['minsize'])
+    await router.check_health(conf['health_timeout'])
+    app['replica_health'] = asyncio.ensure_future(
+        router.run_health_checks(conf['health_interval'], conf['health_timeout']))
+    return router
+
+
+async def init_pg(app):
+    postgres = app['config']['postgres']
+    engine = await create_engine(postgres, app['config']['statement_timeouts']['default'])
+    await engine.prewarm(postgres['minsize'])
     app.db_engine = engine
+    app['read_engine'] = await create_read_engine(app, engine)
+
+    cache_conf = app['config']['auth_cache']
+    auth_cache = TTLCache(maxsize=cache_conf['maxsize'], ttl=cache_conf['ttl'], index=auth_info_user_id)
+    app['repository'] = await repository.create_repository(app['config'], engine, app['read_engine'])
+    # окно чтения прав с основного сервера после сброса кэша - только при наличии реплик
+    primary_window = app['config']['replicas']['read_your_writes'] if has_replicas(app) else 0
+    app['authz_policy'] = DBAuthorizationPolicy(app['repository'], auth_cache, primary_window)
+
+    tokens_conf = app['config']['tokens']
+    if tokens_conf['enabled']:
+        app['identity_policy'] = create_token_policy(tokens_conf, app['authz_policy'])
+        app['authz_policy'].on_invalidate.append(app['identity_policy'].revoke)
+    else:
+        app['identity_policy'] = CookiesIdentityPolicy()
     setup_security(app,
-                   CookiesIdentityPolicy(),
-                   DBAuthorizationPolicy(engine))
+                   app['identity_policy'],
+                   app['authz_policy'])
     return engine
 
 
+@web.middleware
+async def statement_timeout_middleware(request, handler):
+    """statement_timeout маршрута из statement_timeouts.routes; прерванный по нему запрос - ответ 503"""
+    timeouts = request.app['config']['statement_timeouts']
+    token = STATEMENT_TIMEOUT.set(timeouts['routes'].get(request.match_info.route.name, timeouts['default']))
+    try:
+        return await handler(request)
+    except StatementTimeout:
+        raise json_error(web.HTTPServiceUnavailable, 'Query timed out')
+    finally:
+        STATEMENT_TIMEOUT.reset(token)
+
+
+def pool_state(engine) -> dict:
+    return {'size': engine.size, 'free': engine.freesize, 'min': engine.minsize, 'max': engine.maxsize}
+
+
+async def _ping(engine):
+    async with engine.acquire() as conn:
+        await conn.scalar('SELECT 1')
+
+
+async def ready(request):
+    """Готовность к приему запросов: основной пул выдает соединение и отвечает на SELECT 1
+
+    Недоступные реплики готовность не снимают: чтения уходят на основной сервер.
+    """
+    app = request.app
+    primary = pool_state(app.db_engine)
+    try:
+        await asyncio.wait_for(_ping(app.db_engine), app['config']['readiness']['timeout'])
+        primary['ok'] = True
+    except Exception as e:
+        primary['ok'] = False
+        primary['error'] = repr(e)
+
+    pools = {'primary': primary}
+    for replica in getattr(app['read_engine'], 'replicas', []):
+        pools[replica.name] = dict(pool_state(replica.engine), ok=replica.healthy)
+    return json_response({'ready': primary['ok'], 'pools': pools}, status=200 if primary['ok'] else 503)
+
+
 async def close_pg(app):
+    await app['repository'].close()
+    if 'replica_health' in app:
+        app['replica_health'].cancel()
+        app['read_engine'].close()
+        await app['read_engine'].wait_closed()
     app.db_engine.close()
     await app.db_engine.wait_closed()
 
@@ -1,63 +1,138 @@
-import enum
+import time
+from collections import OrderedDict, namedtuple
 from typing import Union
 
-import sqlalchemy as sa
-
 from aiohttp_security.abc import AbstractAuthorizationPolicy
-from passlib.hash import sha256_crypt
 
-import db
+from cache import TTLCache, MISSING
+from replicas import PRIMARY_READS
+
+
+AuthInfo = namedtuple('AuthInfo', ['user_id', 'disabled', 'role'])
+
+
+def auth_info_user_id(info: Union[AuthInfo, None]) -> Union[int, None]:
+    """Вторичный ключ кэша авторизации: сброс по user_id без просмотра всего кэша"""
+    return info.user_id if info is not None else None
 
 
 class DBAuthorizationPolicy(AbstractAuthorizationPolicy):
-    def __init__(self, db_engine):
-        self.db_engine = db_engine
+    """Проверка прав по данным пользователя с кэшированием
+
+    Данные авторизации читаются через read_engine (реплики). Реплика может отставать, поэтому
+    в течение primary_window секунд после сброса кэша пользователь читается с основного
+    сервера, а результат чтения, начатого до сброса, в кэш не попадает.
+    """
+
+    def __init__(self, repository, cache: TTLCache = None, primary_window: float = 0):
+        if cache is not None and cache.index is None:
+            raise ValueError('authorization cache must be indexed by auth_info_user_id')
+        self.repository = repository
+        self.cache = cache
+        self.primary_window = primary_window
+        self.on_invalidate = []
+        self._generation = 0
+        # ('login', login) или ('user_id', id) -> время сброса, в порядке сброса
+        self._invalidated = OrderedDict()
+        self._invalidated_all = float('-inf')
+
+    def _recently_invalidated(self, key) -> bool:
+        now = time.monotonic()
+        while self._invalidated:
+            oldest, invalidated_at = next(iter(self._invalidated.items()))
+            if invalidated_at > now - self.primary_window:
+                break
+            del self._invalidated[oldest]
+        return key in self._invalidated or self._invalidated_all > now - self.primary_window
+
+    def _mark_invalidated(self, key):
+        if self.primary_window:
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = time.monotonic()
+
+    async def _load(self, identity: str, primary: bool) -> Union[AuthInfo, None]:
+        token = PRIMARY_READS.set(True) if primary else None
+        try:
+            row = await self.repository.get_auth_info(identity)
+        finally:
+            if token is not None:
+                PRIMARY_READS.reset(token)
+        return AuthInfo(*row) if row else None
+
+    async def get_auth_info(self, identity: str) -> Union[AuthInfo, None]:
+        """Получение id, признака блокировки и роли пользователя одним запросом с кэшированием"""
+        if self.cache is not None:
+            info = self.cache.get(identity)
+            if info is not MISSING:
+                return info
+
+        generation = self._generation
+        primary = self._recently_invalidated(('login', identity))
+        info = await self._load(identity, primary)
+        if not primary and info is not None and self._recently_invalidated(('user_id', info.user_id)):
+            info = await self._load(identity, True)
+        if self.cache is not None and generation == self._generation:
+            self.cache.set(identity, info)
+        return info
+
+    def invalidate(self, login: str = None, user_id: int = None):
+        """Сброс кэша авторизации после изменения пользователя или его прав"""
+        self._generation += 1
+        if user_id is not None:
+            user_id = int(user_id)
+            self._mark_invalidated(('user_id', user_id))
+            for callback in self.on_invalidate:
+                callback(user_id)
+        if login is not None:
+            self._mark_invalidated(('login', login))
+        if self.cache is None:
+            return
+        if login is not None:
+            self.cache.invalidate(login)
+        if user_id is not None:
+            self.cache.invalidate_indexed(user_id)
+
+    def invalidate_all(self):
+        """Сброс всего кэша авторизации и отзыв токенов всех пользователей (после массовой загрузки)"""
+        self._generation += 1
+        self._invalidated_all = time.monotonic()
+        for callback in self.on_invalidate:
+            callback(None)
+        if self.cache is not None:
+            self.cache.clear()
 
     async def authorized_userid(self, identity: str) -> Union[str, None]:
         """Проверка авторизации пользователя"""
-        async with self.db_engine.acquire() as conn:
-            where = sa.and_(db.users.c.login == identity,
-                            sa.not_(db.users.c.disabled))
-            query = db.users.count().where(where)
-            ret = await conn.scalar(query)
-            if ret:
-                return identity
-            else:
-                return None
+        if getattr(identity, 'claims', None) is not None:
+            return identity
+        info = await self.get_auth_info(identity)
+        if info and not info.disabled:
+            return identity
+        return None
 
     async def permits(self, identity: Union[str, None], permission: str, context=None) -> bool:
         """Проверка наличия права у пользователя"""
         if not identity:
             return False
 
-        async with self.db_engine.acquire() as conn:
-            where = sa.and_(db.users.c.login == identity,
-                            sa.not_(db.users.c.disabled))
-            query = db.users.select().where(where)
-            ret = await conn.execute(query)
-            user = await ret.fetchone()
-            if user:
-                user_id = user[0]
-                where = db.permissions.c.users_id == user_id
-                query = db.permissions.select().where(where)
-                ret = await conn.execute(query)
-                result = await ret.fetchone()
-                if result:
-                    if result.role.value == permission:
-                        return True
+        claims = getattr(identity, 'claims', None)
+        if claims is not None:
+            return claims['role'] == permission
 
-            return False
+        info = await self.get_auth_info(identity)
+        return bool(info and not info.disabled and info.role == permission)
+
+
+async def check_credentials(repository, hasher, username: str, password: str) -> bool:
+    """Проверка правильности пароля
 
+    Если хеш устарел по политике хеширования, после успешной проверки сохраняется новый.
+    """
+    hashed = await repository.get_password(username)
+    if not hashed:
+        return False
 
-async def check_credentials(db_engine, username: str, password: str) -> bool:
-    """Проверка правильности пароля"""
-    async with db_engine.acquire() as conn:
-        where = sa.and_(db.users.c.login == username,
-                        sa.not_(db.users.c.disabled))
-        query = db.users.select().where(where)
-        ret = await conn.execute(query)
-        user = await ret.fetchone()
-        if user:
-            hashed = user.password
-            return sha256_crypt.verify(password, hashed)
-    return False
+    valid, new_hash = await hasher.verify_and_update(password, hashed)
+    if valid and new_hash:
+        await repository.update_password(username, hashed, new_hash)
+    return valid
@@ -1,6 +1,7 @@
-import json
-from datetime import datetime
+import asyncio
+import datetime
 
+import sqlalchemy as sa
 from aiohttp import web
 from aiohttp_apispec import request_schema, docs, response_schema
 
@@ -8,42 +9,389 @@ from aiohttp_security import (
     remember, forget, authorized_userid,
     check_permission, check_authorized,
 )
-from passlib.handlers.sha2_crypt import sha256_crypt
-
-from db_auth import check_credentials
-
 
+import bulk
 import db
+from cache import MISSING
+from changes import format_event, latest_id_query
+from compression import CompressedStreamResponse
+from db_auth import check_credentials
+from ratelimit import LoginRejected
+from replicas import PRIMARY_READS, has_replicas, mark_write
+from repository import USER_LIST_FIELDS, USER_WRITE_FIELDS, users_page_query
+from serializers import dumps, json_response, json_error
 from schemas import UserSchema, LoginSchema, ResponseSchema, ResponseUsersSchema, ResponseUserSchema, \
-    ResponseSchema, UserEditSchema
-
-
-async def get_data(request):
-    """Метод для получения данных из request"""
-    if request.content_type == 'application/json':
-        data = await request.text()
-        data = json.loads(data)
-        return data
-    elif request.content_type == 'multipart/form-data':
-        data = await request.post()
-        return data
+    ResponseSchema, UserEditSchema, ResponseBulkSchema, ResponseWriteSchema
+
+
+# схемы создаются один раз; validation_middleware кладет проверенные данные в request['data']
+user_schema = UserSchema()
+user_edit_schema = UserEditSchema()
+login_schema = LoginSchema()
+
+
+LIKE_ESCAPE = '!'
+
+USER_WRITE_COLUMNS = [db.users.c[field] for field in USER_WRITE_FIELDS]
+
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+def get_int_param(request, name, default, maximum=None):
+    """Получение неотрицательного целого параметра из query string"""
+    value = request.query.get(name)
+    if not value:
+        return default
+    if not value.isdigit():
+        raise json_error(web.HTTPBadRequest, f'Invalid {name}')
+    value = int(value)
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def get_date_param(request, name):
+    """Получение даты в формате YYYY-MM-DD из query string"""
+    value = request.query.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise json_error(web.HTTPBadRequest, f'Invalid {name}')
+
+
+def get_bool_param(request, name):
+    value = request.query.get(name)
+    if not value:
+        return None
+    if value.lower() not in ('true', 'false', '1', '0'):
+        raise json_error(web.HTTPBadRequest, f'Invalid {name}')
+    return value.lower() in ('true', '1')
+
+
+def escape_like(value: str) -> str:
+    """Экранирование спецсимволов LIKE символом LIKE_ESCAPE"""
+    return value.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2).replace('%', LIKE_ESCAPE + '%').replace('_', LIKE_ESCAPE + '_')
+
+
+def users_search_query(after, limit, login=None, name=None, birthday_from=None, birthday_to=None, disabled=None):
+    """Поиск пользователей с постраничной выдачей по id
+
+    Условия рассчитаны на индексы из миграции search_indexes: префикс lower(login),
+    pg_trgm по first_name/last_name, birthday и частичный индекс по активным пользователям.
+    """
+    query = users_page_query(after, limit)
+    if login:
+        query = query.where(sa.func.lower(db.users.c.login).like(escape_like(login.lower()) + '%', escape=LIKE_ESCAPE))
+    if name:
+        pattern = '%' + escape_like(name) + '%'
+        query = query.where(sa.or_(db.users.c.first_name.ilike(pattern, escape=LIKE_ESCAPE),
+                                   db.users.c.last_name.ilike(pattern, escape=LIKE_ESCAPE)))
+    if birthday_from:
+        query = query.where(db.users.c.birthday >= birthday_from)
+    if birthday_to:
+        query = query.where(db.users.c.birthday <= birthday_to)
+    if disabled is not None:
+        query = query.where(db.users.c.disabled == disabled)
+    return query
+
+
+async def stream_users(request, after, fmt):
+    """Потоковая выдача списка пользователей в формате NDJSON или JSON-массива
+
+    Таблица читается пачками по id, соединение возвращается в пул между пачками,
+    поэтому расход памяти не зависит от размера таблицы.
+    """
+    batch_size = request.app['config']['pagination']['stream_batch_size']
+    response = CompressedStreamResponse(headers={'Content-Type': STREAM_FORMATS[fmt]})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    separator = b'\n' if fmt == 'ndjson' else b','
+    first = True
+    if fmt == 'json':
+        await response.write(b'[')
+
+    repository = request.app['repository']
+    while True:
+        users = await repository.list_users(after, batch_size)
+        if not users:
+            break
+
+        chunk = separator.join(dumps(user) for user in users)
+        if fmt == 'ndjson':
+            chunk += b'\n'
+        elif not first:
+            chunk = b',' + chunk
+        first = False
+        await response.write(chunk)
+
+        after = users[-1]['id']
+        if len(users) < batch_size:
+            break
+
+    if fmt == 'json':
+        await response.write(b']')
+    await response.write_eof()
+    return response
+
+
+async def stream_changes(request, after):
+    """Выдача ленты изменений в формате server-sent events
+
+    При after сначала отправляются события журнала после него, затем события в реальном
+    времени. Если часть событий уже удалена из журнала, отправляется событие reset.
+    """
+    feed = request.app['change_feed']
+    heartbeat = request.app['config']['change_feed']['heartbeat']
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                           'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+
+    with feed.subscribe() as queue:
+        if after is None:
+            after = 0
+        elif await feed.missed(after):
+            after = feed.last_id
+            await response.write(b'id: %d\nevent: reset\ndata: {}\n\n' % after)
+        else:
+            while True:
+                events = await feed.history(after)
+                for event in events:
+                    await response.write(format_event(event))
+                    after = event['id']
+                if len(events) < feed.history_batch:
+                    break
+
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                await response.write(b': keepalive\n\n')
+                continue
+            if event is None:
+                break
+            if event['id'] > after:
+                await response.write(format_event(event))
+                after = event['id']
+
+    return response
+
+
+def get_if_match(request):
+    """Версии пользователя из заголовка If-Match ("3", "4"); None - заголовка нет или указан *
+
+    Метка - значение поля version из ответа, а не ETag списка, который зависит от версии таблицы.
+    Слабые (W/) и нечисловые метки не совпадают ни с чем.
+    """
+    header = request.headers.get('If-Match')
+    if header is None or header.strip() == '*':
+        return None
+    versions = []
+    for tag in header.split(','):
+        tag = tag.strip()
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
+
+def user_edit_query(user_id: int, data: dict, versions=None):
+    """UPDATE ... RETURNING с увеличением версии; versions - допустимые версии из If-Match"""
+    query = db.users.update() \
+        .where(db.users.c.id == user_id) \
+        .values(version=db.users.c.version + 1, **data) \
+        .returning(*USER_WRITE_COLUMNS)
+    if versions is not None:
+        query = query.where(db.users.c.version.in_(versions))
+    return query
+
+
+def user_delete_query(user_id: int, versions=None):
+    query = db.users.delete().where(db.users.c.id == user_id).returning(*USER_WRITE_COLUMNS)
+    if versions is not None:
+        query = query.where(db.users.c.version.in_(versions))
+    return query
+
+
+def user_version_query(user_id: int):
+    return sa.select([db.users.c.version]).where(db.users.c.id == user_id)
+
+
+async def missing_or_modified(conn, user_id: int) -> web.HTTPException:
+    """Ошибка для записи, не затронувшей строк: пользователя нет (404) или версия не совпала (412)"""
+    version = await conn.scalar(user_version_query(user_id))
+    if version is None:
+        return json_error(web.HTTPNotFound, 'User not found')
+    return json_error(web.HTTPPreconditionFailed, 'User was modified')
+
+
+def not_modified(request, etag: str) -> bool:
+    """Проверка заголовка If-None-Match; сравнение слабое: сжатые ответы отдаются со слабым ETag"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    return header.strip() == '*' or etag in (tag.strip().replace('W/', '', 1) for tag in header.split(','))
+
+
+async def table_etag(request, table: str) -> str:
+    """ETag по версии таблицы; неизвестная версия читается из журнала изменений на основной базе
+
+    Без ленты изменений журнал читается на каждый запрос: так учитываются записи других
+    процессов и сделанные в обход API.
+    """
+    versions = request.app['versions']
+    version = versions.get(table)
+    if version is None:
+        generation = versions.generation
+        async with request.app.db_engine.acquire() as conn:
+            latest = await conn.scalar(latest_id_query())
+        version = versions.refresh(table, latest, generation)
+    return versions.etag(version)
+
+
+async def conditional_json(request, table: str, build):
+    """JSON-ответ с ETag по версии таблицы
+
+    При совпадении If-None-Match отвечает 304 без построения ответа, успешные тела ответов
+    хранятся в ограниченном кэше по URL и версии таблицы. build возвращает (data, status, headers).
+    Версия берется с основного сервера, поэтому и тело строится по нему: отстающая реплика
+    не должна попасть в кэш под новым ETag.
+    """
+    etag = await table_etag(request, table)
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+
+    cache = request.app['response_cache']
+    key = (request.path_qs, etag)
+    cached = cache.get(key)
+    if cached is MISSING:
+        token = PRIMARY_READS.set(True) if has_replicas(request.app) else None
+        try:
+            data, status, headers = await build()
+        finally:
+            if token is not None:
+                PRIMARY_READS.reset(token)
+        if status != 200:
+            return json_response(data, status=status, headers=headers)
+        cached = (dumps(data), headers)
+        cache.set(key, cached)
+
+    body, headers = cached
+    return web.Response(body=body, headers=dict(headers, ETag=etag), content_type='application/json')
 
 
 class Web(object):
 
     @docs(tags=['list'],
           summary='Список пользователей',
-          description='Получение списка пользователей, доступно любому пользователю')
-    @response_schema(ResponseUsersSchema(), 200)
+          description='Получение списка пользователей, доступно любому пользователю. '
+                      'Постраничная выдача по id: следующая страница запрашивается с after, '
+                      'равным значению заголовка X-Next-After. '
+                      'Параметр stream=ndjson|json включает потоковую выдачу всего списка',
+          parameters=[
+              {'in': 'query', 'name': 'after', 'schema': {'type': 'integer'}},
+              {'in': 'query', 'name': 'limit', 'schema': {'type': 'integer'}},
+              {'in': 'query', 'name': 'stream', 'schema': {'type': 'string', 'enum': list(STREAM_FORMATS)}},
+          ])
+    @response_schema(ResponseUsersSchema(many=True), 200)
     async def index(self, request):
+        """Обработчик для получения списка пользователей"""
+        pagination = request.app['config']['pagination']
+        after = get_int_param(request, 'after', 0)
 
-        async with request.app.db_engine.acquire() as conn:
-            cursor = await conn.execute(db.users.select())
-            records = await cursor.fetchall()
-            fields = ['id', 'login', 'first_name', 'last_name']
-            users = [{field: record[field] for field in fields} for record in records]
+        fmt = request.query.get('stream')
+        if fmt:
+            if fmt not in STREAM_FORMATS:
+                raise json_error(web.HTTPBadRequest, 'Invalid stream')
+            return await stream_users(request, after, fmt)
+
+        limit = get_int_param(request, 'limit', pagination['default_limit'], pagination['max_limit']) or 1
+
+        async def build():
+            users = await request.app['repository'].list_users(after, limit)
+            headers = {}
+            if len(users) == limit:
+                headers['X-Next-After'] = str(users[-1]['id'])
+            return users, 200, headers
+
+        return await conditional_json(request, 'users', build)
 
-            return web.json_response(users)
+    @docs(tags=['list'],
+          summary='Поиск пользователей',
+          description='Поиск по префиксу логина, подстроке имени или фамилии, диапазону дат рождения '
+                      'и признаку блокировки. Постраничная выдача по id, как у списка пользователей. '
+                      'Доступен только администратору: фильтры раскрывают дату рождения и блокировку',
+          parameters=[
+              {'in': 'query', 'name': 'login', 'schema': {'type': 'string'}},
+              {'in': 'query', 'name': 'name', 'schema': {'type': 'string'}},
+              {'in': 'query', 'name': 'birthday_from', 'schema': {'type': 'string', 'format': 'date'}},
+              {'in': 'query', 'name': 'birthday_to', 'schema': {'type': 'string', 'format': 'date'}},
+              {'in': 'query', 'name': 'disabled', 'schema': {'type': 'boolean'}},
+              {'in': 'query', 'name': 'after', 'schema': {'type': 'integer'}},
+              {'in': 'query', 'name': 'limit', 'schema': {'type': 'integer'}},
+          ])
+    @response_schema(ResponseUsersSchema(many=True), 200)
+    async def search(self, request):
+        """Обработчик для поиска пользователей"""
+
+        await check_permission(request, 'admin')
+
+        pagination = request.app['config']['pagination']
+        after = get_int_param(request, 'after', 0)
+        limit = get_int_param(request, 'limit', pagination['default_limit'], pagination['max_limit']) or 1
+        query = users_search_query(
+            after, limit,
+            login=request.query.get('login'),
+            name=request.query.get('name'),
+            birthday_from=get_date_param(request, 'birthday_from'),
+            birthday_to=get_date_param(request, 'birthday_to'),
+            disabled=get_bool_param(request, 'disabled'),
+        )
+
+        async def build():
+            async with request.app['read_engine'].acquire() as conn:
+                cursor = await conn.execute(query)
+                records = await cursor.fetchall()
+
+            users = [dict(zip(USER_LIST_FIELDS, record)) for record in records]
+            headers = {}
+            if len(users) == limit:
+                headers['X-Next-After'] = str(users[-1]['id'])
+            return users, 200, headers
+
+        return await conditional_json(request, 'users', build)
+
+    @docs(tags=['changes'],
+          summary='Лента изменений пользователей',
+          description='Server-sent events о создании, изменении, блокировке и удалении пользователей '
+                      'и их прав. Для продолжения после переподключения передается заголовок '
+                      'Last-Event-ID или параметр after; событие reset означает, что часть событий '
+                      'уже удалена из журнала и список пользователей нужно перечитать. '
+                      'Доступно только администратору',
+          parameters=[
+              {'in': 'query', 'name': 'after', 'schema': {'type': 'integer'}},
+          ])
+    async def changes(self, request):
+        """Обработчик ленты изменений"""
+        await check_permission(request, 'admin')
+
+        if 'change_feed' not in request.app:
+            raise json_error(web.HTTPNotFound, 'Change feed is disabled')
+
+        after = request.headers.get('Last-Event-ID')
+        if after is None:
+            after = get_int_param(request, 'after', None)
+        elif not after.isdigit():
+            raise json_error(web.HTTPBadRequest, 'Invalid Last-Event-ID')
+        else:
+            after = int(after)
+
+        return await stream_changes(request, after)
 
     @docs(tags=['detail'],
           summary='Информация о пользователе',
@@ -56,90 +404,148 @@ class Web(object):
         user_id = request.match_info.get('user_id')
 
         if user_id and user_id.isdigit():
-            async with request.app.db_engine.acquire() as conn:
+            async def build():
                 try:
-                    cursor = await conn.execute(db.users.select().where(db.users.c.id == user_id))
-                    user = await cursor.fetchone()
-                    response = dict(user)
-                    try:
-                        response['birthday'] = datetime.strftime(response['birthday'], '%d-%m-%Y')
-                    except:
-                        pass
-                    status = 200
+                    user = await request.app['repository'].get_user(int(user_id))
+                except db.StatementTimeout:
+                    raise
                 except Exception as e:
-                    response = {'error': str(e)}
-                    status = 400
+                    return {'error': str(e)}, 400, {}
+                if user is None:
+                    return {'error': 'User not found'}, 404, {}
+                return user, 200, {}
 
-                return web.json_response(response, status=status)
+            return await conditional_json(request, 'users', build)
 
     @docs(tags=['create'],
           summary='Создание нового пользователя',
           description='Право создания пользователя предоставлено только администратору')
-    @request_schema(UserSchema())
-    @response_schema(ResponseSchema())
+    @request_schema(user_schema)
+    @response_schema(ResponseWriteSchema(), 201)
     async def create(self, request):
 
         await check_permission(request, 'admin')
 
-        data = await get_data(request)
+        data = dict(request['data'])
         if data['login'] and data['password']:
-            data = dict(data)
-            data['password'] = sha256_crypt.hash(data['password'])
+            data['password'] = await request.app['hasher'].hash(data['password'])
+            query = db.users.insert().values(**data).returning(*USER_WRITE_COLUMNS)
             async with request.app.db_engine.acquire() as conn:
                 try:
-                    cursor = await conn.execute(db.users.insert().values(**data))
-                    response = {'message': 'success'}
+                    cursor = await conn.execute(query)
+                    user = await cursor.fetchone()
+                    mark_write(request)
+                    request.app['authz_policy'].invalidate(login=data['login'])
+                    request.app['versions'].bump('users')
+                    response = dict(user)
                     status = 201
+                except db.StatementTimeout:
+                    raise
                 except Exception as e:
                     response = {'error': str(e)}
                     status = 400
 
-                return web.json_response(response, status=status)
+                return json_response(response, status=status)
+
+    @docs(tags=['create'],
+          summary='Массовое создание пользователей',
+          description='Принимает JSON-массив или NDJSON-поток пользователей (application/x-ndjson), '
+                      'у каждого может быть указана роль role. Пользователи создаются пачками, каждая '
+                      'пачка - в своей транзакции; результат возвращается по каждой строке. '
+                      'JSON-массив ограничен bulk.max_json_size, для больших загрузок нужен NDJSON. '
+                      'Право создания пользователей предоставлено только администратору')
+    @response_schema(ResponseBulkSchema(), 201)
+    async def create_bulk(self, request):
+
+        await check_permission(request, 'admin')
+
+        conf = request.app['config']['bulk']
+        rows = bulk.iter_bulk_rows(request, conf['max_json_size'])
+        try:
+            results = await bulk.create_users(request.app.db_engine, request.app['hasher'], rows,
+                                              conf['batch_size'], conf['max_rows'])
+        except bulk.BodyTooLarge as e:
+            return json_response({'error': str(e)}, status=413)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=400)
+
+        policy = request.app['authz_policy']
+        created = 0
+        for result in results:
+            if 'id' in result:
+                policy.invalidate(login=result['login'])
+                created += 1
+
+        if created:
+            mark_write(request)
+            request.app['versions'].bump('users', 'permissions')
+
+        response = {'created': created, 'failed': len(results) - created, 'results': results}
+        return json_response(response, status=201)
 
     @docs(tags=['edit'],
           summary='Редактирование пользователя',
-          description='Право редактирования пользователя предоставлено только администратору')
-    @request_schema(UserEditSchema())
-    @response_schema(ResponseSchema())
+          description='Право редактирования пользователя предоставлено только администратору. '
+                      'С заголовком If-Match: "<version>" изменение применяется, только если версия '
+                      'пользователя не изменилась, иначе 412')
+    @request_schema(user_edit_schema)
+    @response_schema(ResponseWriteSchema())
     async def edit(self, request):
 
         await check_permission(request, 'admin')
 
         user_id = request.match_info.get('user_id')
-        data = await get_data(request)
+        data = dict(request['data'])
 
         if user_id and user_id.isdigit() and data:
+            user_id = int(user_id)
+            if data.get('password'):
+                data['password'] = await request.app['hasher'].hash(data['password'])
+            query = user_edit_query(user_id, data, get_if_match(request))
             async with request.app.db_engine.acquire() as conn:
                 try:
-                    await conn.execute(db.users.update().where(db.users.c.id == user_id).values(**data))
-                    response = {'message': 'success'}
-                    status = 201
+                    cursor = await conn.execute(query)
+                    user = await cursor.fetchone()
+                except db.StatementTimeout:
+                    raise
                 except Exception as e:
-                    response = {'error': str(e)}
-                    status = 400
+                    return json_response({'error': str(e)}, status=400)
+                if user is None:
+                    raise await missing_or_modified(conn, user_id)
 
-                return web.json_response(response, status=status)
+            mark_write(request)
+            request.app['authz_policy'].invalidate(login=user.login, user_id=user_id)
+            request.app['versions'].bump('users')
+            return json_response(dict(user))
 
     @docs(tags=['delete'],
           summary='Удаление пользователей',
-          description='Право удаления пользователя предоставлено только администратору')
-    @response_schema(ResponseSchema())
+          description='Право удаления пользователя предоставлено только администратору. '
+                      'Поддерживает If-Match: "<version>", как редактирование')
+    @response_schema(ResponseWriteSchema())
     async def delete(self, request):
 
         await check_permission(request, 'admin')
 
         user_id = request.match_info.get('user_id')
         if user_id and user_id.isdigit():
+            user_id = int(user_id)
+            query = user_delete_query(user_id, get_if_match(request))
             async with request.app.db_engine.acquire() as conn:
                 try:
-                    await conn.execute(db.users.delete().where(db.users.c.id == user_id))
-                    response = {'message': 'success'}
-                    status = 201
+                    cursor = await conn.execute(query)
+                    user = await cursor.fetchone()
+                except db.StatementTimeout:
+                    raise
                 except Exception as e:
-                    response = {'error': str(e)}
-                    status = 400
+                    return json_response({'error': str(e)}, status=400)
+                if user is None:
+                    raise await missing_or_modified(conn, user_id)
 
-                return web.json_response(response, status=status)
+            mark_write(request)
+            request.app['authz_policy'].invalidate(login=user.login, user_id=user_id)
+            request.app['versions'].bump('users', 'permissions')
+            return json_response(dict(user))
 
     @docs(tags=['hoami'],
           summary='Проверка авторизации пользователя',
@@ -154,44 +560,61 @@ class Web(object):
             message = 'You need to login'
             status = 401
 
-        return web.json_response({'message': message}, status=status)
+        return json_response({'message': message}, status=status)
 
     @docs(tags=['login'],
           summary='Аутентификация пользователя',
           description='Аутентификация пользователя и добавление идентификатора в cookies')
-    @request_schema(LoginSchema())
+    @request_schema(login_schema)
     @response_schema(ResponseSchema())
     async def login(self, request):
 
-        data = await get_data(request)
+        data = request['data']
 
         if data and data['login'] and data['password']:
             login = data.get('login')
             password = data.get('password')
-            db_engine = request.app.db_engine
-
-            if await check_credentials(db_engine, login, password):
-                response = web.json_response({'message': 'Вы вошли в систему'})
+            limiter = request.app['login_limiter']
+
+            try:
+                limiter.check(login, request.remote)
+                with limiter.verification():
+                    valid = await check_credentials(request.app['repository'], request.app['hasher'], login, password)
+            except LoginRejected as e:
+                raise json_error(web.HTTPTooManyRequests, 'Too many login attempts',
+                                 headers={'Retry-After': str(e.retry_after)})
+
+            if valid:
+                response = json_response({'message': 'Вы вошли в систему'})
                 await remember(request, response, login)
                 return response
 
-            raise web.HTTPUnauthorized(text=json.dumps({'error': 'Invalid username/password combination'}))
+            raise json_error(web.HTTPUnauthorized, 'Invalid username/password combination')
 
     @docs(tags=['logout'],
           summary='Выход пользователя',
-          description='Удаление идентификатора пользователя из cookies')
+          description='Удаление идентификатора пользователя из cookies. С токенами отменяются '
+                      'все сессии пользователя во всех процессах (через ленту изменений)')
     @response_schema(ResponseSchema())
     async def logout(self, request):
-        await check_authorized(request)
-        response = web.json_response({'message': 'Вы вышли из системы'})
+        login = await check_authorized(request)
+        response = json_response({'message': 'Вы вышли из системы'})
         await forget(request, response)
+
+        user_id = request.get('logged_out_user_id')
+        if user_id is not None and 'change_feed' in request.app:
+            async with request.app.db_engine.acquire() as conn:
+                await conn.execute(db.LOGOUT_EVENT, (user_id, str(login)))
         return response
 
     def configure(self, app):
         router = app.router
         router.add_route('GET', '/', self.index, name='index')
+        router.add_route('GET', '/search', self.search, name='search')
+        router.add_route('GET', '/changes', self.changes, name='changes')
         router.add_route('GET', '/detail/{user_id}', self.detail, name='detail')
         router.add_route('POST', '/create', self.create, name='create')
+        router.add_route('POST', '/create/bulk', self.create_bulk, name='create_bulk')
         router.add_route('POST', '/edit/{user_id}', self.edit, name='edit')
         router.add_route('DELETE', '/delete/{user_id}', self.delete, name='delete')
         router.add_route('GET', '/user', self.user, name='user')
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import PASSWORD_HASH_DURATION, record_span
+
+
+logger = logging.getLogger(__name__)
+
+# контекст хеширования в процессе пула, задается через initializer
+_context = None
+
+
+def create_context(conf: dict):
+    """Политика хеширования passlib из секции hashing.context конфигурации
+
+    passlib импортируется здесь: в основном процессе при пуле процессов он не нужен.
+    """
+    from passlib.context import CryptContext
+    return CryptContext(**conf)
+
+
+def _init_context(conf: dict):
+    global _context
+    _context = create_context(conf)
+
+
+def _hash(password: str) -> str:
+    return _context.hash(password)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return _context.verify(password, hashed)
+
+
+def _verify_and_update(password: str, hashed: str):
+    return _context.verify_and_update(password, hashed)
+
+
+class PasswordHasher(object):
+    """Хеширование и проверка паролей в пуле процессов (или потоков) вне event loop"""
+
+    def __init__(self, executor, max_pending: int):
+        self.executor = executor
+        self._semaphore = asyncio.Semaphore(max_pending)
+
+    async def _run(self, operation, func, *args):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                return await loop.run_in_executor(self.executor, func, *args)
+            finally:
+                elapsed = time.perf_counter() - started
+                PASSWORD_HASH_DURATION.observe(elapsed, operation)
+                record_span('hash', elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run('hash', _hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run('verify', _verify, password, hashed)
+
+    async def verify_and_update(self, password: str, hashed: str):
+        """Проверка пароля; вторым значением возвращает новый хеш, если старый устарел по политике"""
+        return await self._run('verify', _verify_and_update, password, hashed)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def create_executor(conf: dict):
+    """Пул процессов для хеширования, при недоступности - пул потоков"""
+    workers = conf.get('workers') or os.cpu_count()
+    initargs = (conf['context'],)
+    if conf['executor'] == 'process':
+        try:
+            return ProcessPoolExecutor(max_workers=workers, initializer=_init_context, initargs=initargs)
+        except (OSError, NotImplementedError, ImportError) as e:
+            logger.warning('Process pool is unavailable, falling back to threads: %s', e)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hashing',
+                              initializer=_init_context, initargs=initargs)
+
+
+async def init_hasher(app):
+    conf = app['config']['hashing']
+    app['hasher'] = PasswordHasher(create_executor(conf), conf['max_pending'])
+
+
+async def close_hasher(app):
+    app['hasher'].close()
+
+
+def calibrate(conf: dict, target_ms: float, samples: int = 5) -> int:
+    """Подбор rounds схемы по умолчанию под целевое время проверки пароля на текущем железе"""
+    context = create_context(conf)
+    scheme = context.handler()
+    probe_rounds = max(scheme.min_rounds, min(scheme.max_rounds, 50000))
+
+    def measure(rounds):
+        hashed = scheme.using(rounds=rounds).hash('calibration')
+        started = time.perf_counter()
+        for _ in range(samples):
+            scheme.verify('calibration', hashed)
+        return (time.perf_counter() - started) / samples * 1000
+
+    rounds = int(probe_rounds * target_ms / measure(probe_rounds))
+    return max(scheme.min_rounds, min(scheme.max_rounds, rounds))
+
+
+if __name__ == '__main__':
+    from settings import config
+
+    parser = argparse.ArgumentParser(description='Калибровка стоимости хеширования паролей')
+    parser.add_argument('--target-ms', type=float, default=50, help='целевое время проверки пароля, мс')
+    args = parser.parse_args()
+
+    context_conf = config['hashing']['context']
+    scheme = create_context(context_conf).handler().name
+    rounds = calibrate(context_conf, args.target_ms)
+    print(f'# {scheme}: ~{args.target_ms:g} ms per verification')
+    print(f'{scheme}__default_rounds: {rounds}')
+    print(f'{scheme}__min_rounds: {rounds}')
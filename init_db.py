@@ -1,11 +1,16 @@
+import argparse
+import io
+import json
 import os
-from datetime import datetime
+import random
+import sys
+from datetime import date, datetime, timedelta
 
-from passlib.handlers.sha2_crypt import sha256_crypt
 from sqlalchemy import MetaData, create_engine
 
 from settings import config
-from db import users, permissions, PermEnum
+from db import users, permissions, user_events, PermEnum, CHANGE_FEED_CHANNEL, RELOAD_EVENT
+from hashing import create_context
 
 
 DSN = "postgresql://{user}:{password}@{host}:{port}/{database}"
@@ -13,16 +18,17 @@ DSN = "postgresql://{user}:{password}@{host}:{port}/{database}"
 
 def create_tables(engine):
     meta = MetaData()
-    tables = [permissions, users]
+    tables = [user_events, permissions, users]
     for table in tables:
         if engine.dialect.has_table(engine, table):
             meta.drop_all(bind=engine, tables=[table])
-    meta.create_all(bind=engine, tables=[users, permissions])
+    meta.create_all(bind=engine, tables=[users, permissions, user_events])
 
 
 def sample_data(engine):
-    admin_pass = sha256_crypt.hash('admin')
-    user_pass = sha256_crypt.hash('user')
+    context = create_context(config['hashing']['context'])
+    admin_pass = context.hash('admin')
+    user_pass = context.hash('user')
     conn = engine.connect()
     conn.execute(users.insert(), [
         {'login': 'admin',
@@ -47,17 +53,183 @@ def sample_data(engine):
     conn.close()
 
 
-if __name__ == '__main__':
+TABLES = {'users': users, 'permissions': permissions}
+
+# значения столбцов NOT NULL, которых может не быть в выгрузках прежних версий схемы
+IMPORT_DEFAULTS = {'users': {'version': 1}, 'permissions': {}}
+
+# CSV с редкими управляющими символами вместо кавычек и разделителя:
+# каждая строка COPY выгружается как есть, без экранирования JSON
+NDJSON_COPY_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+
+FIRST_NAMES = ['Alexander', 'Maria', 'Ivan', 'Anna', 'Dmitry', 'Elena', 'Sergey', 'Olga',
+               'Andrey', 'Natalia', 'Mikhail', 'Tatiana', 'Nikolay', 'Irina', 'Pavel', 'Ekaterina']
+LAST_NAMES = ['Ivanov', 'Smirnov', 'Kuznetsov', 'Popov', 'Vasiliev', 'Petrov', 'Sokolov',
+              'Mikhailov', 'Novikov', 'Fedorov', 'Morozov', 'Volkov', 'Alekseev', 'Lebedev']
+
+
+class IteratorFile(io.TextIOBase):
+    """Файлоподобный объект поверх итератора строк для COPY FROM"""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def reset_sequences(cursor):
+    """Выравнивание последовательностей id после загрузки строк с явными id"""
+    for table in TABLES:
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                       f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)")
+
+
+def disable_change_events(cursor, tables):
+    """Отключение триггеров ленты изменений на время массовой загрузки
+
+    ALTER TABLE блокирует таблицы до конца транзакции загрузки.
+    """
+    for table in tables:
+        cursor.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+
+
+def enable_change_events(cursor, tables):
+    """Включение триггеров и одно событие reload вместо события на каждую строку"""
+    for table in tables:
+        cursor.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER')
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (CHANGE_FEED_CHANNEL,))
+    cursor.execute(RELOAD_EVENT, (tables[0],))
+
+
+def export_table(engine, table, fmt, output):
+    """Выгрузка таблицы через COPY TO в CSV или NDJSON"""
+    if fmt == 'csv':
+        sql = f'COPY {table} TO STDOUT WITH (FORMAT csv, HEADER true)'
+    else:
+        sql = f'COPY (SELECT row_to_json(t) FROM {table} t ORDER BY id) TO STDOUT WITH ({NDJSON_COPY_OPTIONS})'
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(sql, output)
+    finally:
+        conn.close()
+
+
+def import_table(engine, table, fmt, source):
+    """Загрузка таблицы через COPY FROM из CSV или NDJSON"""
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            disable_change_events(cursor, [table])
+            if fmt == 'csv':
+                cursor.copy_expert(f'COPY {table} FROM STDIN WITH (FORMAT csv, HEADER true)', source)
+            else:
+                cursor.execute('CREATE TEMP TABLE import_rows (doc json) ON COMMIT DROP')
+                cursor.copy_expert(f'COPY import_rows FROM STDIN WITH ({NDJSON_COPY_OPTIONS})', source)
+                cursor.execute(f'INSERT INTO {table} SELECT r.* FROM import_rows, '
+                               f'json_populate_record(NULL::{table}, (%s::jsonb || doc::jsonb)::json) r',
+                               (json.dumps(IMPORT_DEFAULTS[table]),))
+            reset_sequences(cursor)
+            enable_change_events(cursor, [table])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def generate_users(engine, count, distinct_passwords=16, admin_ratio=0.01, seed=None):
+    """Генерация count пользователей с заранее вычисленными хешами паролей
+
+    Пароль пользователя - password<N>, где N = номер пользователя % distinct_passwords.
+    """
+    rnd = random.Random(seed)
+    context = create_context(config['hashing']['context'])
+    hashes = [context.hash(f'password{i}') for i in range(distinct_passwords)]
+    start = date(1950, 1, 1)
+    days = (date(2005, 12, 31) - start).days
+
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            disable_change_events(cursor, list(TABLES))
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM users')
+            first_id = cursor.fetchone()[0] + 1
+
+            def rows():
+                for user_id in range(first_id, first_id + count):
+                    birthday = start + timedelta(days=rnd.randrange(days))
+                    yield (f'{user_id}\tuser{user_id}\t{hashes[user_id % distinct_passwords]}\t'
+                           f'{rnd.choice(FIRST_NAMES)}\t{rnd.choice(LAST_NAMES)}\t{birthday.isoformat()}\tf\n')
+
+            cursor.copy_expert('COPY users (id, login, password, first_name, last_name, birthday, disabled) '
+                               'FROM STDIN', IteratorFile(rows()))
+            cursor.execute("INSERT INTO permissions (users_id, role, blocking) "
+                           "SELECT id, CASE WHEN random() < %s THEN 'admin' ELSE 'readonly' END, false "
+                           "FROM users WHERE id >= %s", (admin_ratio, first_id))
+            reset_sequences(cursor)
+            enable_change_events(cursor, list(TABLES))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Инициализация, выгрузка и загрузка базы данных')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('init', help='пересоздать таблицы и добавить тестовых пользователей (по умолчанию)')
+
+    for command in ('export', 'import'):
+        sub = subparsers.add_parser(command, help=f'{command} таблицы через COPY')
+        sub.add_argument('table', choices=list(TABLES))
+        sub.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        sub.add_argument('--file', help='файл, по умолчанию stdout/stdin')
+
+    generate = subparsers.add_parser('generate', help='сгенерировать синтетических пользователей')
+    generate.add_argument('--count', type=int, default=1000000)
+    generate.add_argument('--distinct-passwords', type=int, default=16)
+    generate.add_argument('--admin-ratio', type=float, default=0.01)
+    generate.add_argument('--seed', type=int)
+    return parser.parse_args(argv)
+
+
+def get_engine():
     db_url = DSN.format(
         database=config['postgres']['database'],
         user=config['postgres']['user'],
         password=config['postgres']['password'],
         host=os.environ.get('POSTGRES_HOST', config['postgres']['host']),
         port=config['postgres']['port'],
-        minsize=config['postgres']['minsize'],
-        maxsize=config['postgres']['maxsize']
     )
-    engine = create_engine(db_url)
+    return create_engine(db_url)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    engine = get_engine()
 
-    create_tables(engine)
-    sample_data(engine)
+    if args.command == 'export':
+        with (open(args.file, 'w') if args.file else sys.stdout) as output:
+            export_table(engine, args.table, args.format, output)
+    elif args.command == 'import':
+        with (open(args.file) if args.file else sys.stdin) as source:
+            import_table(engine, args.table, args.format, source)
+    elif args.command == 'generate':
+        generate_users(engine, args.count, args.distinct_passwords, args.admin_ratio, args.seed)
+    else:
+        create_tables(engine)
+        sample_data(engine)
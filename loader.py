@@ -0,0 +1,87 @@
+import asyncio
+
+from replicas import PRIMARY_READS
+
+
+def _consume_exception(future):
+    # исключение общего запроса могло остаться без ожидающих - не пишем предупреждение в лог
+    if not future.cancelled():
+        future.exception()
+
+
+class BatchLoader(object):
+    """Объединение одновременных запросов по ключам в один пакетный запрос
+
+    Одинаковые ключи ждут один и тот же запрос (single flight), разные ключи, пришедшие
+    в течение window секунд, собираются в один вызов batch_fn(keys) -> {key: value}.
+    """
+
+    def __init__(self, batch_fn, window: float, max_batch: int):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._inflight = {}
+        self._handle = None
+
+    async def load(self, key):
+        future = self._inflight.get(key) or self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            future.add_done_callback(_consume_exception)
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._handle is None:
+                self._handle = loop.call_later(self.window, self._dispatch)
+        # отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            self._inflight.update(batch)
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: dict):
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+        else:
+            for key, future in batch.items():
+                future.set_result(results.get(key))
+        finally:
+            for key, future in batch.items():
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+
+class CoalescingRepository(object):
+    """Репозиторий, объединяющий одновременные запросы пользователя по id и данных авторизации по логину
+
+    Чтения сессии, которая недавно писала, не объединяются: общий запрос мог бы уйти на реплику.
+    """
+
+    def __init__(self, repository, window: float, max_batch: int):
+        self._repository = repository
+        self._users = BatchLoader(repository.get_users, window, max_batch)
+        self._auth_infos = BatchLoader(repository.get_auth_infos, window, max_batch)
+
+    def __getattr__(self, name):
+        return getattr(self._repository, name)
+
+    async def get_user(self, user_id: int):
+        if PRIMARY_READS.get():
+            return await self._repository.get_user(int(user_id))
+        return await self._users.load(int(user_id))
+
+    async def get_auth_info(self, login: str):
+        if PRIMARY_READS.get():
+            return await self._repository.get_auth_info(login)
+        return await self._auth_infos.load(login)
@@ -1,32 +1,98 @@
+import argparse
+import inspect
 import logging
 import logging.config
 
 from aiohttp import web
-from aiohttp_apispec import setup_aiohttp_apispec, validation_middleware
 
+import changes
+import compression
 import db
+import hashing
+import metrics
+import openapi
+import ratelimit
+import replicas
+import settings
+import tokens
+import tracing
+import workers
+from cache import TTLCache, TableVersions
 from handlers import Web
 from settings import config
 
 
-def main():
+def create_app(conf):
 
     app = web.Application()
 
-    app['config'] = config
+    app['config'] = conf
+    app['versions'] = TableVersions()
+    app['response_cache'] = TTLCache(maxsize=conf['response_cache']['maxsize'],
+                                     ttl=conf['response_cache']['ttl'])
 
     app.on_startup.append(db.init_pg)
+    app.on_startup.append(hashing.init_hasher)
+    app.on_startup.append(ratelimit.init_login_limiter)
+    app.on_startup.append(changes.init_change_feed)
+    app.on_shutdown.append(changes.close_change_feed)
     app.on_cleanup.append(db.close_pg)
+    app.on_cleanup.append(hashing.close_hasher)
+    app.on_response_prepare.append(tokens.send_refreshed_token)
 
-    logging.basicConfig(level=config['logger_level'])
+    metrics.setup_metrics(app)
+    tracing.setup_tracing(app)
+    compression.setup_compression(app)
+    replicas.setup_read_your_writes(app)
+    app.middlewares.append(db.statement_timeout_middleware)
+    app.router.add_route('GET', '/ready', db.ready, name='ready')
 
     web_handlers = Web()
     web_handlers.configure(app)
 
-    setup_aiohttp_apispec(app, title="My App", swagger_path="/docs")
-    app.middlewares.append(validation_middleware)
+    openapi.setup_openapi(app)
+    app.middlewares.append(tracing.traced_validation_middleware)
+
+    return app
+
+
+def run_options(server: dict) -> dict:
+    """Параметры web.run_app; начиная с aiohttp 3.9 обработчик отменяется при разрыве
+    соединения клиентом только с handler_cancellation=True"""
+    options = {'shutdown_timeout': server['shutdown_timeout']}
+    if 'handler_cancellation' in inspect.signature(web.run_app).parameters:
+        options['handler_cancellation'] = True
+    return options
+
+
+def run_worker(sock, worker_count):
+    """Запуск приложения в рабочем процессе на общем сокете; конфиг читается заново,
+    чтобы перезапуск по SIGHUP применял его изменения"""
+    conf = workers.worker_config(settings.get_config(settings.config_path), worker_count)
+    web.run_app(create_app(conf), sock=sock, **run_options(conf['server']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=config['server']['workers'],
+                        help='количество рабочих процессов')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=config['logger_level'])
+
+    server = config['server']
+    if args.workers <= 1:
+        web.run_app(create_app(config), host=server['host'], port=server['port'], **run_options(server))
+        return
 
-    web.run_app(app)
+    # бюджет соединений проверяется до запуска процессов
+    try:
+        workers.worker_config(config, args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+    sock = workers.create_socket(server['host'], server['port'])
+    master = workers.Master(run_worker, (sock, args.workers), args.workers, server['shutdown_timeout'])
+    master.run()
 
 
 if __name__ == '__main__':
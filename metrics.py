@@ -0,0 +1,194 @@
+import contextvars
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            yield self.name + _format_labels(self.labelnames, labelvalues), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, *labelvalues):
+        """Учет значения: счетчик одной корзины, сумма и количество"""
+        state = self._values.get(labelvalues)
+        if state is None:
+            state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for labelvalues, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                yield f'{self.name}_bucket{labels}', cumulative
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}_sum{labels}', total
+            yield f'{self.name}_count{labels}', count
+
+
+class GaugeCallback(object):
+    """Gauge, значения которого вычисляются в момент выдачи метрик"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callbacks = []
+
+    def samples(self):
+        for callback in self.callbacks:
+            for labelvalues, value in callback():
+                yield self.name + _format_labels(self.labelnames, labelvalues), value
+
+
+class Trace(object):
+    """Время фаз обработки одного запроса: имя фазы -> [секунды, количество]"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name: str, seconds: float):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            span[0] += seconds
+            span[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing, длительности в миллисекундах"""
+        parts = [f'{name};dur={seconds * 1000:.2f}' for name, (seconds, _) in self.spans.items()]
+        parts.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(parts)
+
+    def summary(self) -> str:
+        return ', '.join(f'{name} {seconds * 1000:.1f} ms ({count})' for name, (seconds, count) in self.spans.items())
+
+
+# трассировка текущего запроса (tracing.tracing_middleware)
+TRACE = contextvars.ContextVar('trace', default=None)
+
+
+def record_span(name: str, seconds: float):
+    """Учет времени фазы в трассировке текущего запроса, если она ведется"""
+    trace = TRACE.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['route', 'method'])
+REQUESTS = Counter('http_requests_total', 'HTTP requests', ['route', 'method', 'status'])
+POOL_ACQUIRE_WAIT = Histogram('db_pool_acquire_seconds', 'Time spent waiting for a pool connection')
+QUERY_DURATION = Histogram('db_query_duration_seconds', 'Query duration', ['statement'])
+PASSWORD_HASH_DURATION = Histogram('password_hash_duration_seconds', 'Password hashing time', ['operation'],
+                                   buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOGIN_REJECTED = Counter('login_rejected_total', 'Login attempts rejected before password verification',
+                         ['reason'])
+POOL = GaugeCallback('db_pool_connections', 'Pool connections', ['state'])
+AUTH_CACHE = GaugeCallback('auth_cache', 'Authorization cache statistics', ['stat'])
+REPLICAS = GaugeCallback('db_replica_healthy', 'Read replica health (1 - in rotation, 0 - ejected)', ['replica'])
+
+REGISTRY = [REQUEST_LATENCY, REQUESTS, POOL_ACQUIRE_WAIT, QUERY_DURATION, PASSWORD_HASH_DURATION,
+            LOGIN_REJECTED, POOL, AUTH_CACHE, REPLICAS]
+
+
+def render(registry=REGISTRY) -> str:
+    """Выдача метрик в текстовом формате Prometheus"""
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(f'{name} {value}' for name, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Учет задержки и статуса ответа по именам маршрутов; задержка потоков из
+    tracing.streaming_routes - время жизни подключения, она не учитывается"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.name or 'unmatched'
+        if route not in request.app['config']['tracing']['streaming_routes']:
+            REQUEST_LATENCY.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, status)
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def setup_metrics(app):
+    """Маршрут /metrics и сбор значений пула соединений, кэша авторизации и состояния реплик"""
+    def pool_stats():
+        engine = getattr(app, 'db_engine', None)
+        if engine is None:
+            return []
+        return [(('size',), engine.size), (('free',), engine.freesize),
+                (('min',), engine.minsize), (('max',), engine.maxsize)]
+
+    def auth_cache_stats():
+        policy = app.get('authz_policy')
+        if policy is None or policy.cache is None:
+            return []
+        return [((stat,), value) for stat, value in policy.cache.stats().items()]
+
+    def replica_stats():
+        replicas = getattr(app.get('read_engine'), 'replicas', [])
+        return [((replica.name,), int(replica.healthy)) for replica in replicas]
+
+    POOL.callbacks.append(pool_stats)
+    AUTH_CACHE.callbacks.append(auth_cache_stats)
+    REPLICAS.callbacks.append(replica_stats)
+    app.router.add_route('GET', '/metrics', metrics_handler, name='metrics')
+    app.middlewares.append(metrics_middleware)
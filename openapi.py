@@ -0,0 +1,62 @@
+import argparse
+import logging
+import pathlib
+
+from aiohttp import web
+from aiohttp_apispec import AiohttpApiSpec, setup_aiohttp_apispec
+
+from serializers import dumps, loads
+from settings import BASE_DIR, config
+
+
+logger = logging.getLogger(__name__)
+
+SPEC_OPTIONS = {'title': 'My App', 'version': '0.0.1', 'swagger_path': '/docs'}
+
+
+class PrebuiltApiSpec(AiohttpApiSpec):
+    """Спецификация из готового файла: маршруты при старте не обходятся"""
+
+    def __init__(self, spec: dict, **kwargs):
+        self.prebuilt = spec
+        super().__init__(**kwargs)
+
+    def _register(self, app):
+        app['swagger_dict'] = self.prebuilt
+
+
+def spec_path(conf: dict) -> pathlib.Path:
+    return BASE_DIR / conf['openapi']['prebuilt']
+
+
+def build_spec() -> dict:
+    """Спецификация OpenAPI по обработчикам Web, как ее строит aiohttp_apispec при старте"""
+    from handlers import Web
+
+    app = web.Application()
+    Web().configure(app)
+    spec = AiohttpApiSpec(app=app, in_place=True, url=None,
+                          title=SPEC_OPTIONS['title'], version=SPEC_OPTIONS['version'])
+    return spec.swagger_dict()
+
+
+def setup_openapi(app):
+    """Документация API: готовая спецификация из файла, если он собран, иначе построение при старте"""
+    path = spec_path(app['config'])
+    if path.exists():
+        PrebuiltApiSpec(loads(path.read_bytes()), app=app, in_place=True, **SPEC_OPTIONS)
+    else:
+        logger.info('Prebuilt OpenAPI spec %s not found, building at startup', path)
+        setup_aiohttp_apispec(app, **SPEC_OPTIONS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сборка спецификации OpenAPI в файл')
+    parser.add_argument('--output', type=pathlib.Path, default=spec_path(config))
+    args = parser.parse_args()
+    args.output.write_bytes(dumps(build_spec()))
+    print(f'OpenAPI spec written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
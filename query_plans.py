@@ -0,0 +1,170 @@
+"""Проверка планов запросов обработчиков и политики авторизации
+
+Таблицы создаются по схеме db.py (с индексами из миграций) в отдельной схеме PostgreSQL
+из config/my_app.yaml, заполняются синтетическими данными, после чего для каждого запроса
+из plan_queries выполняется EXPLAIN (FORMAT JSON); запросы AsyncpgUsersRepository проверяются
+через PREPARE и EXPLAIN EXECUTE. План не проходит проверку, если в нем есть Seq Scan, нет
+ожидаемого индекса или его стоимость превышает бюджет запроса. Бюджеты поиска задаются долей
+стоимости полного просмотра users и растут вместе с данными. Запускается тестами:
+    python -m pytest -q tests.py -k plan
+Размер данных задается переменной окружения PLAN_USERS (по умолчанию 100000).
+"""
+import collections
+import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import NullPool
+
+import db
+from changes import first_id_query, history_query, latest_id_query
+from handlers import user_delete_query, user_edit_query, user_version_query, users_search_query
+from init_db import FIRST_NAMES, LAST_NAMES
+from repository import (AsyncpgUsersRepository, auth_info_query, auth_infos_query, password_query,
+                        update_password_query, user_query, users_page_query, users_query)
+
+
+SCHEMA = 'query_plans'
+
+DEFAULT_USERS = 100000
+
+# стоимость точечного поиска по индексу - единицы, полного просмотра таблицы - тысячи
+DEFAULT_COST_BUDGET = 100
+# доля стоимости полного просмотра users, в которую должен укладываться поиск
+SEARCH_COST_SHARE = 0.1
+
+# запрос asyncpg с параметрами $1, $2, ...
+RawQuery = collections.namedtuple('RawQuery', 'sql params')
+
+SEED = [
+    """INSERT INTO users (login, password, first_name, last_name, birthday, disabled)
+       SELECT 'user' || i, 'x',
+              first_names[1 + mod(i, cardinality(first_names))],
+              last_names[1 + mod(i * 7, cardinality(last_names))],
+              date '1950-01-01' + mod(i * 37, 20000),
+              mod(i, 50) = 0
+       FROM generate_series(1, %(users)s) i,
+            (SELECT %(first_names)s::text[] AS first_names, %(last_names)s::text[] AS last_names) names""",
+    """INSERT INTO permissions (users_id, role, blocking)
+       SELECT id, CASE WHEN mod(id, 100) = 0 THEN 'admin' ELSE 'readonly' END, false FROM users""",
+    """INSERT INTO user_events (table_name, op, user_id, login)
+       SELECT 'users', 'create', id, login FROM users""",
+]
+
+
+def plan_queries(users: int, full_scan_cost: float = 0) -> dict:
+    """Запросы для проверки: имя -> (запрос, бюджет стоимости, ожидаемые индексы); вставки не проверяются
+
+    Для выборочных условий поиска план обязан использовать свой индекс, для частых (search_login,
+    search_name, search_birthday) подходит и просмотр по первичному ключу с фильтром до LIMIT.
+    """
+    middle = users // 2
+    login = f'user{middle}'
+    logins = [f'user{i}' for i in range(middle, middle + 100)]
+    search_budget = full_scan_cost * SEARCH_COST_SHARE
+    asyncpg = AsyncpgUsersRepository
+    return {
+        'list_users': (users_page_query(middle, 50), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'search_login': (users_search_query(0, 50, login='user12'), search_budget, ()),
+        'search_login_exact': (users_search_query(0, 50, login=login), search_budget, ('ix_users_lower_login',)),
+        'search_name': (users_search_query(0, 50, name='lexand'), search_budget, ()),
+        'search_name_rare': (users_search_query(0, 50, name='Zakhar'), search_budget,
+                             ('ix_users_first_name_trgm', 'ix_users_last_name_trgm')),
+        'search_birthday': (users_search_query(0, 50, birthday_from=datetime.date(1980, 1, 1),
+                                               birthday_to=datetime.date(1980, 12, 31)), search_budget, ()),
+        'search_birthday_day': (users_search_query(0, 50, birthday_from=datetime.date(1980, 6, 15),
+                                                   birthday_to=datetime.date(1980, 6, 15)), search_budget,
+                                ('ix_users_birthday',)),
+        'search_active': (users_search_query(middle, 50, disabled=False), DEFAULT_COST_BUDGET, ()),
+        'get_user': (user_query(middle), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'get_users': (users_query(range(middle, middle + 100)), DEFAULT_COST_BUDGET * 10, ('users_pkey',)),
+        'auth_info': (auth_info_query().where(db.users.c.login == login), DEFAULT_COST_BUDGET, ()),
+        'auth_infos': (auth_infos_query(logins), DEFAULT_COST_BUDGET * 20, ()),
+        'get_password': (password_query(login), DEFAULT_COST_BUDGET, ()),
+        'update_password': (update_password_query(login, 'x', 'y'), DEFAULT_COST_BUDGET, ()),
+        'edit_user': (user_edit_query(middle, {'first_name': 'Ivan'}, [1]), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'delete_user': (user_delete_query(middle, [1]), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'user_version': (user_version_query(middle), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'changes_latest_id': (latest_id_query(), DEFAULT_COST_BUDGET, ()),
+        'changes_first_id': (first_id_query(), DEFAULT_COST_BUDGET, ()),
+        'changes_history': (history_query(middle, 1000), DEFAULT_COST_BUDGET * 10, ()),
+        'asyncpg_list_users': (RawQuery(asyncpg.LIST_USERS, [middle, 50]), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'asyncpg_get_user': (RawQuery(asyncpg.GET_USER, [middle]), DEFAULT_COST_BUDGET, ('users_pkey',)),
+        'asyncpg_get_users': (RawQuery(asyncpg.GET_USERS, [list(range(middle, middle + 100))]),
+                              DEFAULT_COST_BUDGET * 10, ('users_pkey',)),
+        'asyncpg_auth_info': (RawQuery(asyncpg.GET_AUTH_INFO, [login]), DEFAULT_COST_BUDGET, ()),
+        'asyncpg_auth_infos': (RawQuery(asyncpg.GET_AUTH_INFOS, [logins]), DEFAULT_COST_BUDGET * 20, ()),
+        'asyncpg_get_password': (RawQuery(asyncpg.GET_PASSWORD, [login]), DEFAULT_COST_BUDGET, ()),
+        'asyncpg_update_password': (RawQuery(asyncpg.UPDATE_PASSWORD, [login, 'x', 'y']),
+                                    DEFAULT_COST_BUDGET, ()),
+    }
+
+
+def create_engine(conf: dict):
+    """Engine с search_path на схему проверки: рабочие таблицы базы не затрагиваются"""
+    connect_args = dict(db.connection_params(conf), connect_timeout=5,
+                        options=f'-c search_path={SCHEMA},public')
+    return sa.create_engine('postgresql://', connect_args=connect_args,
+                            isolation_level='AUTOCOMMIT', poolclass=NullPool)
+
+
+def seed(conn, users: int):
+    """Пересоздание схемы проверки и заполнение таблиц; триггеры ленты изменений отключены"""
+    conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+    conn.execute(f'CREATE SCHEMA {SCHEMA}')
+    db.meta.create_all(bind=conn, tables=[db.users, db.permissions, db.user_events], checkfirst=False)
+    for table in ('users', 'permissions'):
+        conn.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+    for statement in SEED:
+        conn.execute(statement, users=users, first_names=FIRST_NAMES, last_names=LAST_NAMES)
+    conn.execute('VACUUM ANALYZE users, permissions, user_events')
+
+
+def drop(conn):
+    conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+
+
+def explain(conn, query) -> dict:
+    """План запроса из EXPLAIN (FORMAT JSON) без выполнения
+
+    Запрос asyncpg подготавливается через PREPARE с теми же параметрами $n и объясняется
+    через EXPLAIN EXECUTE с конкретными значениями.
+    """
+    cursor = conn.connection.cursor()
+    try:
+        if isinstance(query, RawQuery):
+            cursor.execute('PREPARE plan_check AS ' + query.sql)
+            try:
+                placeholders = ', '.join(['%s'] * len(query.params))
+                cursor.execute(f'EXPLAIN (FORMAT JSON) EXECUTE plan_check({placeholders})', query.params)
+                return cursor.fetchone()[0][0]['Plan']
+            finally:
+                cursor.execute('DEALLOCATE plan_check')
+        compiled = query.compile(dialect=postgresql.dialect())
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params)
+        return cursor.fetchone()[0][0]['Plan']
+    finally:
+        cursor.close()
+
+
+def full_scan_cost(conn) -> float:
+    """Стоимость полного просмотра users - мера бюджетов поиска"""
+    return explain(conn, db.users.select())['Total Cost']
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+def plan_problems(plan: dict, budget: float, indexes=()) -> list:
+    """Нарушения плана: последовательные просмотры таблиц, неиспользованные ожидаемые индексы
+    и превышение бюджета стоимости"""
+    problems = [f'Seq Scan on {node["Relation Name"]}'
+                for node in plan_nodes(plan) if node['Node Type'] == 'Seq Scan']
+    used = {node.get('Index Name') for node in plan_nodes(plan)}
+    problems.extend(f'index {index} is not used' for index in indexes if index not in used)
+    if plan['Total Cost'] > budget:
+        problems.append(f'cost {plan["Total Cost"]} exceeds budget {budget}')
+    return problems
@@ -0,0 +1,79 @@
+import math
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import LOGIN_REJECTED
+
+
+class LoginRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets(object):
+    """Token bucket по ключу; хранится не более max_keys последних ключей"""
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def take(self, key) -> float:
+        """Списание токена; возвращает 0 или время в секундах до появления токена"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class LoginLimiter(object):
+    """Допуск попыток входа до проверки пароля: ограничение частоты по логину и адресу
+    и общего числа одновременных проверок"""
+
+    def __init__(self, per_login: dict, per_ip: dict, max_concurrent: int, max_keys: int):
+        self.per_login = TokenBuckets(per_login['rate'], per_login['burst'], max_keys)
+        self.per_ip = TokenBuckets(per_ip['rate'], per_ip['burst'], max_keys)
+        self.max_concurrent = max_concurrent
+        self.active = 0
+
+    def _reject(self, reason: str, wait: float):
+        LOGIN_REJECTED.inc(reason)
+        raise LoginRejected(reason, max(1, math.ceil(wait)))
+
+    def check(self, login: str, address: str):
+        wait = self.per_ip.take(address)
+        if wait:
+            self._reject('ip', wait)
+        wait = self.per_login.take(login)
+        if wait:
+            self._reject('login', wait)
+
+    @contextmanager
+    def verification(self):
+        if self.active >= self.max_concurrent:
+            self._reject('concurrency', 1)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+
+async def init_login_limiter(app):
+    conf = app['config']['login_limits']
+    app['login_limiter'] = LoginLimiter(conf['per_login'], conf['per_ip'],
+                                        conf['max_concurrent'], conf['max_keys'])
@@ -0,0 +1,157 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+WRITE_COOKIE = 'AIOHTTP_WROTE'
+
+# чтения текущего запроса идут на основной сервер (сессия недавно писала)
+PRIMARY_READS = contextvars.ContextVar('primary_reads', default=False)
+
+
+class Replica(object):
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = True
+
+    def load(self) -> float:
+        """Доля занятых соединений пула"""
+        return (self.engine.size - self.engine.freesize) / self.engine.maxsize
+
+    def eject(self, reason):
+        if self.healthy:
+            logger.warning('Replica %s ejected: %r', self.name, reason)
+        self.healthy = False
+
+    def readmit(self):
+        if not self.healthy:
+            logger.info('Replica %s is healthy again', self.name)
+        self.healthy = True
+
+
+class _RoutedAcquire(object):
+    __slots__ = ('_router', '_acquire')
+
+    def __init__(self, router):
+        self._router = router
+        self._acquire = None
+
+    async def __aenter__(self):
+        replica = self._router.choose()
+        if replica is not None:
+            self._acquire = replica.engine.acquire()
+            try:
+                return await self._acquire.__aenter__()
+            except Exception as e:
+                # недоступная реплика исключается сразу, запрос уходит на основной сервер
+                replica.eject(e)
+        self._acquire = self._router.primary.acquire()
+        return await self._acquire.__aenter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._acquire.__aexit__(exc_type, exc, tb)
+        self._acquire = None
+
+
+class ReadRouter(object):
+    """Engine только для чтения: распределяет соединения по исправным репликам
+
+    Стратегии: round_robin - по очереди, least_loaded - реплика с наименьшей долей
+    занятых соединений. Если исправных реплик нет или сессия недавно писала
+    (PRIMARY_READS), чтение идет на основной сервер.
+    """
+
+    STRATEGIES = ('round_robin', 'least_loaded')
+
+    def __init__(self, primary, replicas: list, strategy: str = 'round_robin', minsize: int = 0):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f'Unknown replica strategy: {strategy}')
+        self.primary = primary
+        self.replicas = replicas
+        self.strategy = strategy
+        self.minsize = minsize
+        self._counter = itertools.count()
+
+    def choose(self):
+        """Реплика для очередного чтения или None для основного сервера"""
+        if PRIMARY_READS.get():
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        start = next(self._counter) % len(healthy)
+        if self.strategy == 'least_loaded':
+            # сдвиг по кругу, чтобы при равной нагрузке реплики выбирались по очереди
+            return min(healthy[start:] + healthy[:start], key=Replica.load)
+        return healthy[start]
+
+    def acquire(self):
+        return _RoutedAcquire(self)
+
+    async def _ping(self, replica: Replica):
+        async with replica.engine.acquire() as conn:
+            await conn.scalar('SELECT 1')
+        # пул исправной реплики заполняется до minsize, чтобы чтения не ждали подключения
+        if replica.engine.size < self.minsize:
+            await replica.engine.prewarm(self.minsize)
+
+    async def check_health(self, timeout: float):
+        for replica in self.replicas:
+            try:
+                await asyncio.wait_for(self._ping(replica), timeout)
+            except Exception as e:
+                replica.eject(e)
+            else:
+                replica.readmit()
+
+    async def run_health_checks(self, interval: float, timeout: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_health(timeout)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.engine.close()
+
+    async def wait_closed(self):
+        for replica in self.replicas:
+            await replica.engine.wait_closed()
+
+
+def has_replicas(app) -> bool:
+    """Настроены ли реплики; без них все чтения и так идут на основной сервер"""
+    return bool(app['config']['replicas']['dsns'])
+
+
+def mark_write(request):
+    """Отметка записи: до конца запроса и в течение replicas.read_your_writes секунд
+    после него чтения этой сессии идут на основной сервер; без реплик ничего не делает"""
+    if not has_replicas(request.app):
+        return
+    request['wrote'] = True
+    PRIMARY_READS.set(True)
+
+
+@web.middleware
+async def read_your_writes_middleware(request, handler):
+    token = PRIMARY_READS.set(WRITE_COOKIE in request.cookies)
+    try:
+        response = await handler(request)
+    finally:
+        PRIMARY_READS.reset(token)
+
+    if request.get('wrote') and not response.prepared:
+        window = request.app['config']['replicas']['read_your_writes']
+        response.set_cookie(WRITE_COOKIE, '1', max_age=window, httponly=True, samesite='Lax')
+    return response
+
+
+def setup_read_your_writes(app):
+    if has_replicas(app):
+        app.middlewares.append(read_your_writes_middleware)
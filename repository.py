@@ -0,0 +1,216 @@
+import asyncio
+import os
+import time
+from typing import Union
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+import db
+from loader import CoalescingRepository
+from metrics import QUERY_DURATION, record_span
+
+
+USER_LIST_FIELDS = ('id', 'login', 'first_name', 'last_name')
+USER_DETAIL_FIELDS = ('id', 'login', 'password', 'first_name', 'last_name', 'birthday', 'disabled', 'version')
+# поля пользователя в ответах на запись (RETURNING), без хеша пароля
+USER_WRITE_FIELDS = ('id', 'login', 'first_name', 'last_name', 'birthday', 'disabled', 'version')
+
+
+def auth_info_query():
+    return sa.select([db.users.c.login, db.users.c.id, db.users.c.disabled, db.permissions.c.role]) \
+        .select_from(db.users.outerjoin(db.permissions, db.permissions.c.users_id == db.users.c.id))
+
+
+def _role(role):
+    return role.value if role is not None else None
+
+
+def users_page_query(after, limit):
+    """Запрос страницы списка пользователей по ключу id (keyset pagination)"""
+    columns = [db.users.c[field] for field in USER_LIST_FIELDS]
+    return sa.select(columns) \
+        .where(db.users.c.id > after) \
+        .order_by(db.users.c.id) \
+        .limit(limit)
+
+
+def user_query(user_id):
+    return db.users.select().where(db.users.c.id == user_id)
+
+
+def users_query(user_ids):
+    ids = sa.bindparam('ids', list(user_ids), type_=ARRAY(sa.Integer))
+    return db.users.select().where(db.users.c.id == sa.func.any(ids))
+
+
+def auth_infos_query(logins):
+    names = sa.bindparam('logins', list(logins), type_=ARRAY(sa.String))
+    return auth_info_query().where(db.users.c.login == sa.func.any(names))
+
+
+def password_query(login):
+    where = sa.and_(db.users.c.login == login,
+                    sa.not_(db.users.c.disabled))
+    return sa.select([db.users.c.password]).where(where)
+
+
+def update_password_query(login, old_hash, new_hash):
+    return db.users.update() \
+        .where(sa.and_(db.users.c.login == login, db.users.c.password == old_hash)) \
+        .values(password=new_hash)
+
+
+class UsersRepository(object):
+    """Фиксированные запросы чтения поверх aiopg engine
+
+    Используются для списка и карточки пользователя, проверки прав и пароля.
+    Список, карточка и права читаются через read_engine (реплики), пароль - с основного сервера.
+    """
+
+    def __init__(self, engine, read_engine=None):
+        self.engine = engine
+        self.read_engine = read_engine or engine
+
+    async def list_users(self, after: int, limit: int) -> list:
+        async with self.read_engine.acquire() as conn:
+            cursor = await conn.execute(users_page_query(after, limit))
+            records = await cursor.fetchall()
+        return [dict(zip(USER_LIST_FIELDS, record)) for record in records]
+
+    async def get_user(self, user_id: int) -> Union[dict, None]:
+        async with self.read_engine.acquire() as conn:
+            cursor = await conn.execute(user_query(user_id))
+            user = await cursor.fetchone()
+        return dict(user) if user else None
+
+    async def get_users(self, user_ids: list) -> dict:
+        """Пользователи по списку id одним запросом WHERE id = ANY(...)"""
+        async with self.read_engine.acquire() as conn:
+            cursor = await conn.execute(users_query(user_ids))
+            return {user.id: dict(user) for user in await cursor.fetchall()}
+
+    async def get_auth_info(self, login: str) -> Union[tuple, None]:
+        """(id, disabled, role) пользователя одним запросом"""
+        async with self.read_engine.acquire() as conn:
+            cursor = await conn.execute(auth_info_query().where(db.users.c.login == login))
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        return row.id, row.disabled, _role(row.role)
+
+    async def get_auth_infos(self, logins: list) -> dict:
+        """(id, disabled, role) по списку логинов одним запросом WHERE login = ANY(...)"""
+        async with self.read_engine.acquire() as conn:
+            cursor = await conn.execute(auth_infos_query(logins))
+            return {row.login: (row.id, row.disabled, _role(row.role)) for row in await cursor.fetchall()}
+
+    async def get_password(self, login: str) -> Union[str, None]:
+        """Хеш пароля активного пользователя"""
+        async with self.engine.acquire() as conn:
+            return await conn.scalar(password_query(login))
+
+    async def update_password(self, login: str, old_hash: str, new_hash: str):
+        async with self.engine.acquire() as conn:
+            await conn.execute(update_password_query(login, old_hash, new_hash))
+
+    async def close(self):
+        pass
+
+
+class AsyncpgUsersRepository(object):
+    """Те же запросы через asyncpg: бинарный протокол и подготовленные выражения,
+    которые asyncpg кэширует на каждом соединении пула"""
+
+    LIST_USERS = 'SELECT id, login, first_name, last_name FROM users WHERE id > $1 ORDER BY id LIMIT $2'
+    GET_USER = f'SELECT {", ".join(USER_DETAIL_FIELDS)} FROM users WHERE id = $1'
+    GET_USERS = f'SELECT {", ".join(USER_DETAIL_FIELDS)} FROM users WHERE id = ANY($1::int[])'
+    GET_AUTH_INFO = ('SELECT u.id, u.disabled, p.role FROM users u '
+                     'LEFT JOIN permissions p ON p.users_id = u.id WHERE u.login = $1')
+    GET_AUTH_INFOS = ('SELECT u.login, u.id, u.disabled, p.role FROM users u '
+                      'LEFT JOIN permissions p ON p.users_id = u.id WHERE u.login = ANY($1::text[])')
+    GET_PASSWORD = 'SELECT password FROM users WHERE login = $1 AND NOT disabled'
+    UPDATE_PASSWORD = 'UPDATE users SET password = $3 WHERE login = $1 AND password = $2'
+
+    def __init__(self, pool, statement_timeout: int = 0):
+        self.pool = pool
+        self.statement_timeout = statement_timeout
+
+    async def _fetch(self, statement: str, method: str, sql: str, *args):
+        """Запрос с таймаутом маршрута; asyncpg сам отменяет запрос на сервере по таймауту и при отмене задачи"""
+        timeout = db.STATEMENT_TIMEOUT.get()
+        if timeout is None:
+            timeout = self.statement_timeout
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                return await getattr(conn, method)(sql, *args, timeout=timeout / 1000 or None)
+        except asyncio.TimeoutError:
+            raise db.StatementTimeout() from None
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_DURATION.observe(elapsed, statement)
+            record_span('sql', elapsed)
+
+    async def list_users(self, after: int, limit: int) -> list:
+        records = await self._fetch('select', 'fetch', self.LIST_USERS, after, limit)
+        return [dict(record) for record in records]
+
+    async def get_user(self, user_id: int) -> Union[dict, None]:
+        record = await self._fetch('select', 'fetchrow', self.GET_USER, int(user_id))
+        return dict(record) if record else None
+
+    async def get_users(self, user_ids: list) -> dict:
+        records = await self._fetch('select', 'fetch', self.GET_USERS, [int(user_id) for user_id in user_ids])
+        return {record['id']: dict(record) for record in records}
+
+    async def get_auth_info(self, login: str) -> Union[tuple, None]:
+        record = await self._fetch('select', 'fetchrow', self.GET_AUTH_INFO, login)
+        return tuple(record) if record else None
+
+    async def get_auth_infos(self, logins: list) -> dict:
+        records = await self._fetch('select', 'fetch', self.GET_AUTH_INFOS, list(logins))
+        return {record['login']: tuple(record)[1:] for record in records}
+
+    async def get_password(self, login: str) -> Union[str, None]:
+        return await self._fetch('select', 'fetchval', self.GET_PASSWORD, login)
+
+    async def update_password(self, login: str, old_hash: str, new_hash: str):
+        await self._fetch('update', 'execute', self.UPDATE_PASSWORD, login, old_hash, new_hash)
+
+    async def close(self):
+        await self.pool.close()
+
+
+async def create_repository(conf: dict, engine, read_engine=None):
+    """Репозиторий выбранного в storage.backend драйвера, с объединением запросов, если оно включено"""
+    repository = await _create_backend(conf, engine, read_engine)
+    coalescing = conf['coalescing']
+    if coalescing['enabled']:
+        repository = CoalescingRepository(repository, coalescing['window_ms'] / 1000, coalescing['max_batch'])
+    return repository
+
+
+async def _create_backend(conf: dict, engine, read_engine):
+    if conf['storage']['backend'] == 'aiopg':
+        return UsersRepository(engine, read_engine)
+    if conf['replicas']['dsns']:
+        raise RuntimeError('replicas are supported only with storage.backend aiopg')
+
+    try:
+        import asyncpg
+    except ImportError:
+        raise RuntimeError('storage.backend is asyncpg, but asyncpg is not installed')
+
+    postgres = conf['postgres']
+    pool = await asyncpg.create_pool(
+        database=postgres['database'],
+        user=postgres['user'],
+        password=postgres['password'],
+        host=os.environ.get('POSTGRES_HOST', postgres['host']),
+        port=postgres['port'],
+        min_size=postgres['minsize'],
+        max_size=postgres['maxsize'],
+        statement_cache_size=conf['storage']['statement_cache_size'],
+    )
+    return AsyncpgUsersRepository(pool, conf['statement_timeouts']['default'])
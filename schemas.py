@@ -6,16 +6,20 @@ class UserSchema(Schema):
     password = fields.String(required=True)
     first_name = fields.String()
     last_name = fields.String()
-    birthday = fields.String()
+    birthday = fields.Date()
     disabled = fields.Bool(default=False)
 
 
+class BulkUserSchema(UserSchema):
+    role = fields.String(validate=validate.OneOf(["admin", "readonly"]))
+
+
 class UserEditSchema(Schema):
     login = fields.String(required=True)
     password = fields.String()
     first_name = fields.String()
     last_name = fields.String()
-    birthday = fields.String()
+    birthday = fields.Date()
     disabled = fields.Bool(default=False)
 
 
@@ -33,7 +37,6 @@ class LoginSchema(Schema):
 class ResponseUsersSchema(Schema):
     id = fields.Integer()
     login = fields.String()
-    password = fields.String()
     first_name = fields.String()
     last_name = fields.String()
 
@@ -46,8 +49,37 @@ class ResponseUserSchema(Schema):
     last_name = fields.String()
     birthday = fields.String()
     disabled = fields.Bool()
+    version = fields.Integer()
+
+
+class ResponseWriteSchema(Schema):
+    id = fields.Integer()
+    login = fields.String()
+    first_name = fields.String()
+    last_name = fields.String()
+    birthday = fields.String()
+    disabled = fields.Bool()
+    version = fields.Integer()
 
 
 class ResponseSchema(Schema):
     data = fields.Dict()
 
+
+class BulkResultSchema(Schema):
+    index = fields.Integer()
+    id = fields.Integer()
+    login = fields.String()
+    error = fields.Raw()
+
+
+class ResponseBulkSchema(Schema):
+    created = fields.Integer()
+    failed = fields.Integer()
+    results = fields.List(fields.Nested(BulkResultSchema))
+
+
+class ProfileSchema(Schema):
+    route = fields.String(required=True)
+    requests = fields.Integer(missing=1, validate=validate.Range(min=1))
+    mode = fields.String(missing='cprofile', validate=validate.OneOf(["cprofile", "sampling"]))
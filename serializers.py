@@ -0,0 +1,50 @@
+import datetime
+import json
+import time
+
+from aiohttp import web
+
+from metrics import record_span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+    def loads(data):
+        return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    started = time.perf_counter()
+    try:
+        return _dumps(obj)
+    finally:
+        record_span('json', time.perf_counter() - started)
+
+
+def json_response(data, status: int = 200, headers=None) -> web.Response:
+    """JSON-ответ, закодированный через orjson (или stdlib json, если orjson не установлен)"""
+    return web.Response(body=dumps(data), status=status, headers=headers, content_type='application/json')
+
+
+def json_error(exc_class, message: str, **kwargs):
+    """HTTP-исключение aiohttp с телом {'error': message}"""
+    return exc_class(body=dumps({'error': message}), content_type='application/json', **kwargs)
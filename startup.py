@@ -0,0 +1,94 @@
+import asyncio
+import re
+import subprocess
+import sys
+import time
+
+from settings import BASE_DIR
+
+
+IMPORT_TIME = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)')
+
+
+def import_times(module: str = 'main') -> list:
+    """Время импорта (мс, вместе с зависимостями) модулей, которые module импортирует напрямую
+
+    Замер в отдельном интерпретаторе с -X importtime, чтобы модули не были уже загружены.
+    Общая зависимость учитывается у модуля, который импортировал ее первым.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=BASE_DIR, capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            entries.append((len(match.group(2)) // 2, match.group(3), int(match.group(1)) / 1000))
+
+    # модуль выводится после своих зависимостей, прямые зависимости на уровень глубже
+    index = max(i for i, (_, name, _) in enumerate(entries) if name == module)
+    depth, _, total = entries[index]
+    children = []
+    for child_depth, name, cumulative in reversed(entries[:index]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            children.append((name, cumulative))
+    children.sort(key=lambda item: item[1], reverse=True)
+    return [(module, total)] + children
+
+
+def time_startup(app, timings: list):
+    """Замер времени каждого обработчика on_startup приложения"""
+    def timed(callback):
+        name = getattr(callback, '__qualname__', repr(callback))
+        module = getattr(callback, '__module__', None)
+        if module:
+            name = f'{module}.{name}'
+
+        async def wrapper(app):
+            started = time.perf_counter()
+            try:
+                await callback(app)
+            finally:
+                timings.append((name, (time.perf_counter() - started) * 1000))
+        return wrapper
+
+    app.on_startup[:] = [timed(callback) for callback in app.on_startup]
+
+
+async def startup_times(conf: dict, timings: list):
+    """Время создания приложения и его обработчиков on_startup (мс); нужна доступная база"""
+    from aiohttp import web
+    from main import create_app
+
+    started = time.perf_counter()
+    app = create_app(conf)
+    timings.append(('create_app', (time.perf_counter() - started) * 1000))
+    time_startup(app, timings)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await runner.cleanup()
+
+
+def print_report(title: str, rows: list):
+    print(title)
+    for name, ms in rows:
+        print(f'  {ms:9.1f} ms  {name}')
+
+
+def main():
+    from settings import config
+
+    print_report('Imports (cumulative):', import_times())
+
+    timings = []
+    try:
+        asyncio.run(startup_times(config, timings))
+    except Exception as e:
+        print(f'Startup failed: {e!r}')
+    print_report('Startup:', timings)
+
+
+if __name__ == '__main__':
+    main()
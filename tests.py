@@ -1,5 +1,34 @@
+import asyncio
+import collections
+import datetime
+import os
+
 import pytest
+import sqlalchemy as sa
 from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from sqlalchemy.dialects import postgresql
+
+import bulk
+import openapi
+import query_plans
+from bench import compare, percentile
+from cache import TTLCache, TableVersions, MISSING
+from changes import ChangeFeed, format_event
+from compression import CompressedStreamResponse, negotiate, setup_compression
+from db import STATEMENT_TIMEOUT, MeteredConnection, MeteredEngine, StatementTimeout
+from db_auth import AuthInfo, DBAuthorizationPolicy, auth_info_user_id
+from handlers import conditional_json, get_if_match, users_page_query, users_search_query
+from hashing import PasswordHasher, create_context, create_executor
+from loader import CoalescingRepository
+from metrics import Histogram, record_span, render
+from ratelimit import LoginLimiter, LoginRejected
+from replicas import PRIMARY_READS, ReadRouter, Replica, mark_write
+from serializers import dumps, json_response, loads
+from settings import config
+from tokens import TokenIdentityPolicy, TokenSigner, create_token_policy
+from tracing import setup_tracing
+from workers import worker_config
 
 
 async def previous(request):
@@ -31,3 +60,671 @@ async def test_get(cli):
     assert await resp.json() == {"value": "index"}
 
 
+def test_users_page_query():
+    query = users_page_query(after=10, limit=50)
+    sql = str(query)
+    assert 'password' not in sql
+    assert 'users.id > :id_1' in sql
+    assert 'ORDER BY users.id' in sql
+    assert query.compile().params == {'id_1': 10, 'param_1': 50}
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=60, index=lambda value: value % 2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1
+    cache.invalidate_indexed(1)
+    assert cache.get('a') is MISSING and cache.get('c') is MISSING
+    assert cache.stats() == {'size': 0, 'maxsize': 2, 'hits': 2, 'misses': 3}
+    assert cache._index == {}
+
+    cache = TTLCache(maxsize=2, ttl=0)
+    cache.set('a', 1)
+    assert cache.get('a') is MISSING
+
+
+async def test_password_hasher():
+    context = {'schemes': ['sha256_crypt'], 'sha256_crypt__default_rounds': 6000,
+               'sha256_crypt__min_rounds': 6000}
+    hasher = PasswordHasher(create_executor({'executor': 'thread', 'workers': 1, 'context': context}),
+                            max_pending=2)
+    hashed = await hasher.hash('secret')
+    assert await hasher.verify('secret', hashed)
+    assert not await hasher.verify('wrong', hashed)
+    assert await hasher.verify_and_update('secret', hashed) == (True, None)
+
+    weak = create_context(dict(context, sha256_crypt__min_rounds=1000)).hash('secret', rounds=1000)
+    valid, new_hash = await hasher.verify_and_update('secret', weak)
+    assert valid and new_hash and '$rounds=6000$' in new_hash
+    hasher.close()
+
+
+def test_histogram_render():
+    histogram = Histogram('latency_seconds', 'Latency', ['route'], buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'index')
+    histogram.observe(0.5, 'index')
+    histogram.observe(5, 'index')
+    lines = render([histogram]).splitlines()
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{route="index",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="index",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="index",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{route="index"} 3' in lines
+
+
+def test_bench_compare():
+    assert percentile([0.3, 0.1, 0.2], 50) == 0.2
+    baseline = {'routes': {'index': {'rps': 1000, 'p99_ms': 10.0}}}
+    assert compare({'routes': {'index': {'rps': 950, 'p99_ms': 10.5}}}, baseline, 0.1) == []
+    regressions = compare({'routes': {'index': {'rps': 800, 'p99_ms': 20.0}}}, baseline, 0.1)
+    assert regressions == ['index: rps 1000 -> 800', 'index: p99 10.0ms -> 20.0ms']
+
+
+def test_serializers_encode_dates():
+    data = {'login': 'user', 'birthday': datetime.date(2001, 11, 11)}
+    assert loads(dumps(data)) == {'login': 'user', 'birthday': '2001-11-11'}
+
+
+def test_table_versions_etag():
+    versions = TableVersions()
+    assert versions.get('users') is None
+    assert versions.refresh('users', 10, versions.generation) == 10
+    assert versions.get('users') is None
+
+    versions.start(10, 'users', 'permissions')
+    assert versions.etag(versions.get('users')) == '"10"'
+    versions.advance(11)
+    assert versions.get('users') == 11
+    assert versions.get('permissions') == 11
+
+    versions.bump('users')
+    assert versions.get('users') is None
+    versions.advance(12)
+    assert versions.get('users') is None
+    generation = versions.generation
+    versions.bump('users')
+    assert versions.refresh('users', 11, generation) == 12
+    assert versions.get('users') is None
+    assert versions.refresh('users', 13, versions.generation) == 13
+    assert versions.get('users') == 13
+
+
+def test_users_search_query_escapes_patterns():
+    query = users_search_query(after=0, limit=10, login='Ad_m', name='50%', disabled=False)
+    compiled = query.compile(dialect=postgresql.dialect())
+    sql = str(compiled)
+    assert 'lower(users.login) LIKE' in sql
+    assert 'users.first_name ILIKE' in sql and 'users.last_name ILIKE' in sql
+    assert 'users.disabled = false' in sql
+    assert compiled.params['lower_1'] == 'ad!_m%'
+    assert compiled.params['first_name_1'] == '%50!%%'
+
+
+def test_if_match_versions():
+    def if_match(value):
+        return get_if_match(make_mocked_request('PUT', '/user/1', headers={'If-Match': value}))
+
+    assert get_if_match(make_mocked_request('PUT', '/user/1')) is None
+    assert if_match('*') is None
+    assert if_match('"3", W/"4", "abc", "5"') == [3, 5]
+    assert if_match('W/"4"') == []
+
+
+async def test_conditional_json_builds_from_primary():
+    app = web.Application()
+    app['config'] = {'replicas': {'dsns': ['postgresql://replica']}}
+    app['versions'] = TableVersions()
+    app['versions'].start(7, 'users')
+    app['response_cache'] = TTLCache(maxsize=10, ttl=60)
+    reads = []
+
+    async def build():
+        reads.append(PRIMARY_READS.get())
+        return [{'id': 1}], 200, {}
+
+    for _ in range(2):
+        resp = await conditional_json(make_mocked_request('GET', '/', app=app), 'users', build)
+        assert resp.headers['ETag'] == '"7"' and loads(resp.body) == [{'id': 1}]
+    assert reads == [True] and not PRIMARY_READS.get()
+    resp = await conditional_json(make_mocked_request('GET', '/', headers={'If-None-Match': '"7"'}, app=app),
+                                  'users', build)
+    assert resp.status == 304
+
+
+def test_mark_write_without_replicas():
+    app = web.Application()
+    app['config'] = {'replicas': {'dsns': []}}
+    request = make_mocked_request('POST', '/create', app=app)
+    mark_write(request)
+    assert 'wrote' not in request and not PRIMARY_READS.get()
+
+
+def test_token_signer():
+    signer = TokenSigner('secret')
+    token = signer.dumps({'sub': 'admin', 'uid': 1, 'role': 'admin'})
+    assert signer.loads(token) == {'sub': 'admin', 'uid': 1, 'role': 'admin'}
+    payload, _, signature = token.partition('.')
+    assert signer.loads(payload + '.' + signature[::-1]) is None
+    assert TokenSigner('other').loads(token) is None
+    assert signer.loads('garbage') is None
+
+
+def test_token_policy(monkeypatch):
+    conf = {'secret': 'change-me', 'ttl': 300, 'refresh_ttl': 86400, 'epoch': 1, 'cookie_name': 'token'}
+    policy = DBAuthorizationPolicy(None)
+    monkeypatch.delenv('TOKEN_SECRET', raising=False)
+    with pytest.raises(RuntimeError):
+        create_token_policy(conf, policy)
+    monkeypatch.setenv('TOKEN_SECRET', 'real-secret')
+    tokens = create_token_policy(conf, policy)
+
+    tokens._revoked = {1: 0, 2: 0}
+    tokens.revoke(3)
+    tokens.revoke(3)
+    assert list(tokens._revoked) == [3]
+
+
+async def test_token_refresh_and_logout():
+    users = {'admin': AuthInfo(1, False, 'admin')}
+
+    async def load_auth_info(login):
+        return users.get(login)
+
+    tokens = TokenIdentityPolicy(load_auth_info, 'secret', ttl=300, refresh_ttl=86400, epoch=1,
+                                 cookie_name='token')
+
+    def request_with(claims):
+        headers = {'Authorization': 'Bearer ' + tokens.signer.dumps(claims)}
+        return make_mocked_request('GET', '/', headers=headers)
+
+    claims = await tokens._issue('admin')
+    assert await tokens.identify(request_with(claims)) == 'admin'
+
+    # логин перешел к другому пользователю: истекший токен не продлевается
+    expired = dict(claims, exp=0)
+    users['admin'] = AuthInfo(2, False, 'admin')
+    assert await tokens.identify(request_with(expired)) is None
+    users['admin'] = AuthInfo(1, False, 'admin')
+    assert await tokens.identify(request_with(expired)) == 'admin'
+
+    request = request_with(claims)
+    await tokens.forget(request, web.Response())
+    assert request['logged_out_user_id'] == 1
+    assert await tokens.identify(request_with(claims)) is None
+    assert await tokens.identify(request_with(expired)) is None
+    assert await tokens.identify(request_with(await tokens._issue('admin'))) == 'admin'
+
+
+def test_worker_config_splits_connections():
+    conf = {'postgres': {'minsize': 2, 'maxsize': 5}}
+    assert worker_config(conf, 2)['postgres'] == {'minsize': 2, 'maxsize': 2}
+    with pytest.raises(ValueError):
+        worker_config(conf, 6)
+
+
+def test_login_limiter():
+    limiter = LoginLimiter({'rate': 0.5, 'burst': 2}, {'rate': 100, 'burst': 100},
+                           max_concurrent=1, max_keys=10)
+    limiter.check('admin', '127.0.0.1')
+    limiter.check('admin', '127.0.0.1')
+    with pytest.raises(LoginRejected) as e:
+        limiter.check('admin', '127.0.0.1')
+    assert e.value.reason == 'login' and e.value.retry_after == 2
+    limiter.check('user', '127.0.0.1')
+
+    with limiter.verification():
+        with pytest.raises(LoginRejected):
+            with limiter.verification():
+                pass
+    assert limiter.active == 0
+
+
+class FakeRepository:
+    def __init__(self, users):
+        self.users = users
+        self.calls = 0
+
+    async def get_auth_info(self, login):
+        self.calls += 1
+        return self.users.get(login)
+
+    async def get_auth_infos(self, logins):
+        self.calls += 1
+        return {login: self.users[login] for login in logins if login in self.users}
+
+    async def get_users(self, user_ids):
+        self.calls += 1
+        return {}
+
+
+async def test_authorization_policy_cache():
+    repository = FakeRepository({'admin': (1, False, 'admin'), 'blocked': (2, True, 'admin')})
+    policy = DBAuthorizationPolicy(repository, TTLCache(maxsize=10, ttl=60, index=auth_info_user_id))
+
+    assert await policy.permits('admin', 'admin')
+    assert not await policy.permits('admin', 'readonly')
+    assert await policy.authorized_userid('admin') == 'admin'
+    assert repository.calls == 1
+
+    assert not await policy.permits('blocked', 'admin')
+    assert await policy.authorized_userid('missing') is None
+
+    policy.invalidate(user_id=1)
+    assert await policy.permits('admin', 'admin')
+    assert repository.calls == 4
+
+    revoked = []
+    policy.on_invalidate.append(revoked.append)
+    policy.invalidate_all()
+    assert len(policy.cache) == 0 and revoked == [None]
+
+
+async def test_authorization_policy_reads_primary_after_invalidate():
+    primary_reads = []
+
+    class ReplicaRepository(FakeRepository):
+        async def get_auth_info(self, login):
+            primary_reads.append(PRIMARY_READS.get())
+            await asyncio.sleep(0)
+            return await super().get_auth_info(login)
+
+    repository = ReplicaRepository({'admin': (1, False, 'admin')})
+    policy = DBAuthorizationPolicy(repository, TTLCache(maxsize=10, ttl=60, index=auth_info_user_id), primary_window=60)
+    await policy.get_auth_info('admin')
+    policy.invalidate(user_id=1)
+    await policy.get_auth_info('admin')
+    policy.invalidate(login='admin')
+    await policy.get_auth_info('admin')
+    assert primary_reads == [False, False, True, True]
+
+    # чтение, начатое до сброса, в кэш не попадает
+    lookup = asyncio.ensure_future(policy.get_auth_info('user'))
+    await asyncio.sleep(0)
+    policy.invalidate(login='admin')
+    await lookup
+    assert 'user' not in policy.cache._data
+
+
+class FakeBulkConnection:
+    """Соединение для bulk: логин fail роняет весь INSERT, timeout - таймаут запроса"""
+
+    def __init__(self, users):
+        self.users = users
+        self.permissions = []
+        self.inserts = 0
+
+    def begin(self):
+        return FakeContext(self)
+
+    def begin_nested(self):
+        return FakeContext(self)
+
+    async def execute(self, query):
+        rows = query.parameters
+        if query.table.name == 'permissions':
+            self.permissions.extend(rows)
+            return None
+        self.inserts += 1
+        logins = [row['login'] for row in rows]
+        if 'timeout' in logins:
+            raise StatementTimeout()
+        if 'fail' in logins:
+            raise Exception('value too long')
+        created = []
+        for login in logins:
+            if login not in self.users:
+                self.users[login] = len(self.users) + 1
+                created.append(collections.namedtuple('Row', 'id login')(self.users[login], login))
+        return FakeCursor(created)
+
+
+class FakeContext:
+    def __init__(self, value):
+        self.value = value
+
+    async def __aenter__(self):
+        return self.value
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetchall(self):
+        return self.rows
+
+
+class FakeBulkEngine:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return FakeContext(self.conn)
+
+
+class FakeHasher:
+    async def hash(self, password):
+        return 'hashed:' + password
+
+
+async def iterate(rows):
+    for row in rows:
+        yield row
+
+
+async def test_bulk_create_users():
+    conn = FakeBulkConnection({'admin': 1})
+    rows = [
+        {'login': 'ivan', 'password': 'x', 'role': 'admin'},
+        {'login': 'admin', 'password': 'x'},
+        {'login': 'ivan', 'password': 'x'},
+        {'login': 'fail', 'password': 'x'},
+        {'login': 'anna'},
+        ValueError('unexpected character'),
+        {'login': 'olga', 'password': 'x'},
+        {'login': 'over', 'password': 'x'},
+    ]
+    results = await bulk.create_users(FakeBulkEngine(conn), FakeHasher(), iterate(rows), batch_size=4, max_rows=7)
+
+    assert [result.get('id') for result in results] == [2, None, None, None, None, None, 3, None]
+    assert results[1]['error'] == results[2]['error'] == 'User with this login already exists'
+    assert results[3]['error'] == 'value too long'
+    assert 'password' in results[4]['error']
+    assert results[5]['error'] == ['unexpected character']
+    assert results[7]['error'] == 'Too many rows, the limit is 7'
+    # пачка с ошибкой повторяется построчно в savepoint
+    assert conn.inserts == 1 + 4 + 1
+    assert conn.permissions == [{'users_id': 2, 'role': 'admin'}]
+
+    with pytest.raises(StatementTimeout):
+        await bulk.create_users(FakeBulkEngine(conn), FakeHasher(),
+                                iterate([{'login': 'timeout', 'password': 'x'}, {'login': 'pavel', 'password': 'x'}]),
+                                batch_size=10, max_rows=10)
+    assert conn.inserts == 7
+
+
+async def test_bulk_rows(aiohttp_client):
+    async def rows(request):
+        try:
+            data = [row if isinstance(row, dict) else str(row)
+                    async for row in bulk.iter_bulk_rows(request, max_json_size=100)]
+        except bulk.BodyTooLarge:
+            return web.json_response('too large', status=413)
+        return web.json_response(data)
+
+    app = web.Application()
+    app.router.add_post('/', rows)
+    client = await aiohttp_client(app)
+
+    resp = await client.post('/', data=b'{"login": "a"}\n\nnot json\n{"login": "b"}\n',
+                             headers={'Content-Type': 'application/x-ndjson'})
+    data = await resp.json()
+    assert data[0] == {'login': 'a'} and isinstance(data[1], str) and data[2] == {'login': 'b'}
+
+    resp = await client.post('/', json=[{'login': 'a'}])
+    assert await resp.json() == [{'login': 'a'}]
+    resp = await client.post('/', json=[{'login': 'a' * 200}])
+    assert resp.status == 413
+
+
+async def test_coalescing_repository():
+    repository = FakeRepository({'admin': (1, False, 'admin'), 'user': (2, False, 'readonly')})
+    coalescing = CoalescingRepository(repository, window=0.01, max_batch=10)
+
+    results = await asyncio.gather(*(coalescing.get_auth_info(login)
+                                      for login in ('admin', 'user', 'admin', 'missing')))
+    assert results == [(1, False, 'admin'), (2, False, 'readonly'), (1, False, 'admin'), None]
+    assert repository.calls == 1
+    assert await coalescing.get_user(1) is None
+    assert repository.calls == 2
+
+
+class FakeEngine:
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.fail = fail
+        self.size, self.freesize, self.maxsize = 0, 0, 5
+
+    def acquire(self):
+        engine = self
+
+        class Acquire:
+            async def __aenter__(self):
+                if engine.fail:
+                    raise OSError('connection refused')
+                return engine
+
+            async def __aexit__(self, *args):
+                pass
+
+        return Acquire()
+
+    async def scalar(self, query):
+        return 1
+
+
+async def test_read_router():
+    primary = FakeEngine('primary')
+    replicas = [Replica('r0', FakeEngine('r0')), Replica('r1', FakeEngine('r1', fail=True))]
+    router = ReadRouter(primary, replicas)
+
+    async def read():
+        async with router.acquire() as conn:
+            return conn.name
+
+    assert [await read() for _ in range(3)] == ['r0', 'primary', 'r0']
+    assert not replicas[1].healthy
+
+    token = PRIMARY_READS.set(True)
+    assert await read() == 'primary'
+    PRIMARY_READS.reset(token)
+
+    replicas[1].engine.fail = False
+    await router.check_health(timeout=1)
+    assert [replica.healthy for replica in replicas] == [True, True]
+
+
+async def test_change_feed_publish():
+    feed = ChangeFeed(None, None, queue_size=2, history_batch=100)
+    applied = []
+    feed.callbacks.append(applied.append)
+    event = {'id': 1, 'table': 'users', 'op': 'disable', 'user_id': 7, 'login': 'user'}
+    assert format_event(event) == b'id: 1\ndata: ' + dumps(event) + b'\n\n'
+
+    with feed.subscribe() as fast, feed.subscribe() as slow:
+        feed.publish(event)
+        feed.publish(event)
+        assert fast.get_nowait() == event and fast.empty()
+        assert applied == [event]
+
+        for event_id in (2, 3):
+            feed.publish(dict(event, id=event_id))
+        assert slow.get_nowait() is None
+        assert feed.subscribers == {fast}
+
+
+async def test_prebuilt_openapi(aiohttp_client, tmp_path):
+    spec = openapi.build_spec()
+    assert '/changes' in spec['paths']
+    path = tmp_path / 'openapi.json'
+    path.write_bytes(dumps(spec))
+
+    app = web.Application()
+    app['config'] = {'openapi': {'prebuilt': str(path)}}
+    openapi.setup_openapi(app)
+    assert 'swagger_dict' in app
+
+    client = await aiohttp_client(app)
+    resp = await client.get('/api/docs/swagger.json')
+    assert await resp.json() == loads(dumps(spec))
+
+
+class FakeQueryConnection:
+    """aiopg-соединение: запрос ждет, пока его не отменит cancel() или statement_timeout"""
+
+    def __init__(self):
+        self.cancelled = False
+        self.connection = self
+        self.raw = self
+        self.executed = []
+
+    def cancel(self):
+        # вызывается из потока исполнителя, как PQcancel
+        self.cancelled = True
+        self.query.get_loop().call_soon_threadsafe(self.query.set_exception, asyncio.CancelledError())
+
+    async def execute(self, query):
+        self.executed.append(query)
+        if query.startswith('SET'):
+            return
+        self.query = asyncio.get_running_loop().create_future()
+        return await self.query
+
+
+async def test_query_cancellation():
+    conn = FakeQueryConnection()
+    task = asyncio.ensure_future(MeteredConnection(conn).execute('SELECT pg_sleep(10)'))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert conn.cancelled
+
+    conn = FakeQueryConnection()
+    task = asyncio.ensure_future(MeteredConnection(conn).execute('SELECT pg_sleep(10)'))
+    await asyncio.sleep(0.01)
+    conn.query.set_exception(asyncio.CancelledError())
+    with pytest.raises(StatementTimeout):
+        await task
+    assert not conn.cancelled
+
+    engine = MeteredEngine(None, statement_timeout=5000)
+    token = STATEMENT_TIMEOUT.set(1000)
+    await engine.apply_timeout(conn)
+    await engine.apply_timeout(conn)
+    STATEMENT_TIMEOUT.reset(token)
+    await engine.apply_timeout(conn)
+    assert conn.executed[1:] == ['SET statement_timeout = 1000', 'SET statement_timeout = 5000']
+
+
+async def traced(request):
+    record_span('sql', 0.002)
+    return json_response({'value': 1})
+
+
+async def test_tracing(aiohttp_client, caplog):
+    app = web.Application()
+    app['config'] = {'tracing': {
+        'slow_ms': 0, 'server_timing': True, 'server_timing_skip_routes': ['login'], 'streaming_routes': ['changes'],
+        'profile': {'max_requests': 10, 'keep_results': 5, 'stats_limit': 10, 'sample_interval_ms': 1}}}
+    setup_tracing(app)
+    app.router.add_get('/traced', traced, name='traced')
+    app.router.add_get('/login', traced, name='login')
+    app.router.add_get('/changes', traced, name='changes')
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/traced')
+    timing = resp.headers['Server-Timing']
+    assert timing.startswith('sql;dur=2.00, json;dur=') and 'total;dur=' in timing
+    assert 'Server-Timing' not in (await client.get('/login')).headers
+
+    caplog.clear()
+    await client.get('/changes')
+    await client.get('/traced')
+    assert [record.getMessage().split(':')[0] for record in caplog.records] == ['Slow request GET /traced']
+
+    app['profiler'].arm('traced', 1, 'cprofile')
+    await client.get('/traced')
+    await client.get('/traced')
+    state = app['profiler'].state()
+    assert state['remaining'] == 0 and len(state['results']) == 1
+    assert 'function calls' in state['results'][0]['output']
+
+
+async def compressed(request):
+    if 'stream' in request.query:
+        response = CompressedStreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for i in range(100):
+            await response.write(dumps({'id': i, 'login': f'user{i}'}) + b'\n')
+        await response.write_eof()
+        return response
+    count = int(request.query['count'])
+    return json_response([{'id': i, 'login': f'user{i}'} for i in range(count)], headers={'ETag': '"1"'})
+
+
+async def test_compression(aiohttp_client):
+    assert negotiate('gzip;q=0.5, br', ['zstd', 'gzip']) == 'gzip'
+    assert negotiate('gzip;q=0, *', ['gzip']) is None
+    assert negotiate('*;q=0.1', ['zstd', 'gzip']) == 'zstd'
+    assert negotiate('', ['gzip']) is None
+
+    app = web.Application()
+    app['config'] = {'compression': {
+        'enabled': True, 'encodings': ['gzip'], 'levels': {'gzip': 6}, 'min_size': 1024,
+        'executor_min_size': 4096, 'types': ['application/json', 'application/x-ndjson']}}
+    setup_compression(app)
+    app.router.add_get('/', compressed)
+    client = await aiohttp_client(app)
+
+    resp = await client.get('/?count=5', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers and resp.headers['ETag'] == '"1"'
+
+    for count in (100, 1000):
+        resp = await client.get(f'/?count={count}', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip' and resp.headers['Vary'] == 'Accept-Encoding'
+        assert resp.headers['ETag'] == 'W/"1"'
+        assert len(await resp.json()) == count
+
+    resp = await client.get('/?count=100', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in resp.headers and resp.headers['Vary'] == 'Accept-Encoding'
+
+    resp = await client.get('/?stream=1', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    lines = (await resp.read()).splitlines()
+    assert len(lines) == 100 and loads(lines[-1]) == {'id': 99, 'login': 'user99'}
+
+
+def test_plan_problems():
+    plan = {'Node Type': 'Nested Loop', 'Total Cost': 120.5, 'Plans': [
+        {'Node Type': 'Index Scan', 'Relation Name': 'users', 'Total Cost': 8.4},
+        {'Node Type': 'Seq Scan', 'Relation Name': 'permissions', 'Total Cost': 100.0},
+    ]}
+    assert query_plans.plan_problems(plan, 200) == ['Seq Scan on permissions']
+    assert query_plans.plan_problems(plan['Plans'][0], 100) == []
+    assert query_plans.plan_problems(plan['Plans'][0], 5) == ['cost 8.4 exceeds budget 5']
+    plan['Plans'][0]['Index Name'] = 'users_pkey'
+    assert query_plans.plan_problems(plan, 200, ('users_pkey', 'ix_users_birthday')) == \
+        ['Seq Scan on permissions', 'index ix_users_birthday is not used']
+
+
+@pytest.fixture(scope='module')
+def plan_db():
+    """Схема query_plans в PostgreSQL из конфига с синтетическими данными; без базы тесты пропускаются"""
+    users = int(os.environ.get('PLAN_USERS', query_plans.DEFAULT_USERS))
+    engine = query_plans.create_engine(config['postgres'])
+    try:
+        conn = engine.connect()
+    except sa.exc.OperationalError as e:
+        pytest.skip(f'PostgreSQL is not available: {e}')
+    try:
+        query_plans.seed(conn, users)
+        yield conn, users
+    finally:
+        query_plans.drop(conn)
+        conn.close()
+
+
+@pytest.mark.parametrize('name', sorted(query_plans.plan_queries(query_plans.DEFAULT_USERS)))
+def test_query_plan(plan_db, name):
+    conn, users = plan_db
+    query, budget, indexes = query_plans.plan_queries(users, query_plans.full_scan_cost(conn))[name]
+    plan = query_plans.explain(conn, query)
+    assert not query_plans.plan_problems(plan, budget, indexes), dumps(plan).decode()
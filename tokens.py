@@ -0,0 +1,197 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+from typing import Union
+
+from aiohttp_security.abc import AbstractIdentityPolicy
+
+from serializers import dumps, loads
+
+
+TOKEN_HEADER = 'X-Auth-Token'
+
+# значения секрета, с которыми приложение не запускается: ими может подписать токен кто угодно
+INSECURE_SECRETS = ('', 'change-me')
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class TokenSigner(object):
+    """Подпись и проверка токенов вида base64(payload).base64(HMAC-SHA256)"""
+
+    def __init__(self, secret: str):
+        self._secret = secret.encode()
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._secret, payload.encode(), hashlib.sha256).digest())
+
+    def dumps(self, claims: dict) -> str:
+        payload = _b64encode(dumps(claims))
+        return f'{payload}.{self._sign(payload)}'
+
+    def loads(self, token: str) -> Union[dict, None]:
+        payload, _, signature = token.partition('.')
+        if not signature or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            return loads(_b64decode(payload))
+        except ValueError:
+            return None
+
+
+def _prune(marks: dict, before: float):
+    """Удаление отметок старше before; словарь упорядочен по времени отметки"""
+    while marks:
+        key, marked_at = next(iter(marks.items()))
+        if marked_at > before:
+            break
+        del marks[key]
+
+
+class TokenIdentity(str):
+    """Логин пользователя вместе с проверенными данными токена"""
+
+    def __new__(cls, login: str, claims: dict):
+        identity = super().__new__(cls, login)
+        identity.claims = claims
+        return identity
+
+
+class TokenIdentityPolicy(AbstractIdentityPolicy):
+    """Подписанные токены с id, логином и ролью пользователя
+
+    Пока токен не истек (ttl), права проверяются без обращения к базе. Истекший токен
+    продлевается до refresh_ttl с момента входа: при продлении пользователь и его роль
+    перечитываются через load_auth_info. Токены отзываются сменой epoch в конфигурации
+    или вызовом revoke(user_id) - после него токены пользователя принудительно продлеваются.
+    Отметка об отзыве хранится ttl секунд: выданные до нее токены к этому времени истекают.
+    Выход (logout) отменяет все сессии пользователя, начатые до него, включая продление:
+    отметка хранится refresh_ttl секунд. Другим процессам она рассылается через ленту изменений;
+    с выключенной лентой действует только в процессе, обработавшем выход.
+    """
+
+    def __init__(self, load_auth_info, secret: str, ttl: int, refresh_ttl: int, epoch: int,
+                 cookie_name: str):
+        self.load_auth_info = load_auth_info
+        self.signer = TokenSigner(secret)
+        self.ttl = ttl
+        self.refresh_ttl = refresh_ttl
+        self.epoch = epoch
+        self.cookie_name = cookie_name
+        self._revoked = {}
+        self._revoked_all = 0
+        self._logged_out = {}
+
+    def revoke(self, user_id: int = None):
+        """Отзыв токенов пользователя; без user_id - токенов всех пользователей"""
+        now = int(time.time())
+        if user_id is None:
+            self._revoked_all = now
+            return
+        user_id = int(user_id)
+        # словарь упорядочен по времени отзыва: повторный отзыв переносит запись в конец
+        self._revoked.pop(user_id, None)
+        self._revoked[user_id] = now
+        _prune(self._revoked, now - self.ttl)
+
+    def logout(self, user_id: int):
+        """Выход пользователя: сессии, начатые раньше, не принимаются и не продлеваются"""
+        now = time.time()
+        user_id = int(user_id)
+        self._logged_out.pop(user_id, None)
+        self._logged_out[user_id] = now
+        _prune(self._logged_out, now - self.refresh_ttl)
+
+    def _get_token(self, request) -> Union[str, None]:
+        authorization = request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            return authorization[7:].strip()
+        return request.cookies.get(self.cookie_name)
+
+    async def _issue(self, login: str, refresh_until: int = None, user_id: int = None,
+                     session_at: float = None) -> Union[dict, None]:
+        """Новые данные токена; при продлении логин должен по-прежнему принадлежать user_id,
+        иначе после переименования токен перешел бы к новому владельцу логина"""
+        info = await self.load_auth_info(login)
+        if not info or info.disabled or (user_id is not None and info.user_id != user_id):
+            return None
+        started = time.time()
+        now = int(started)
+        return {'sub': login, 'uid': info.user_id, 'role': info.role, 'iat': now, 'exp': now + self.ttl,
+                'rat': refresh_until or now + self.refresh_ttl, 'sat': session_at or started, 'ep': self.epoch}
+
+    async def identify(self, request):
+        if 'token_identity' not in request:
+            request['token_identity'] = await self._identify(request)
+        return request['token_identity']
+
+    async def _identify(self, request):
+        token = self._get_token(request)
+        if not token:
+            return None
+        claims = self.signer.loads(token)
+        if not claims or claims.get('ep') != self.epoch:
+            return None
+
+        now = time.time()
+        if claims.get('sat', 0) < self._logged_out.get(claims['uid'], -1):
+            return None
+        revoked = max(self._revoked.get(claims['uid'], 0), self._revoked_all)
+        if claims['exp'] > now and claims['iat'] > revoked:
+            return TokenIdentity(claims['sub'], claims)
+        if claims['rat'] <= now:
+            return None
+
+        claims = await self._issue(claims['sub'], claims['rat'], claims['uid'], claims.get('sat'))
+        if claims is None:
+            return None
+        request['refreshed_token'] = self.signer.dumps(claims)
+        return TokenIdentity(claims['sub'], claims)
+
+    def set_token(self, response, token: str):
+        response.set_cookie(self.cookie_name, token, max_age=self.refresh_ttl, httponly=True, samesite='Lax')
+        response.headers[TOKEN_HEADER] = token
+
+    async def remember(self, request, response, identity, **kwargs):
+        claims = await self._issue(identity)
+        if claims is not None:
+            self.set_token(response, self.signer.dumps(claims))
+
+    async def forget(self, request, response):
+        """Выход: кроме удаления cookie отменяются сессии пользователя - копия токена
+        (в том числе в заголовке Authorization) больше не принимается"""
+        identity = await self.identify(request)
+        if identity is not None:
+            self.logout(identity.claims['uid'])
+            request['logged_out_user_id'] = identity.claims['uid']
+        response.del_cookie(self.cookie_name)
+
+
+def create_token_policy(conf: dict, authz_policy) -> TokenIdentityPolicy:
+    """Политика токенов; секрет из TOKEN_SECRET или tokens.secret, общий для всех рабочих процессов"""
+    secret = os.environ.get('TOKEN_SECRET') or conf['secret']
+    if secret in INSECURE_SECRETS:
+        raise RuntimeError('tokens.enabled requires a real secret: set TOKEN_SECRET (the same for all workers)')
+    return TokenIdentityPolicy(
+        authz_policy.get_auth_info,
+        secret=secret,
+        ttl=conf['ttl'],
+        refresh_ttl=conf['refresh_ttl'],
+        epoch=conf['epoch'],
+        cookie_name=conf['cookie_name'],
+    )
+
+
+async def send_refreshed_token(request, response):
+    """on_response_prepare: отправка продленного токена клиенту"""
+    token = request.get('refreshed_token')
+    if token is not None:
+        request.app['identity_policy'].set_token(response, token)
@@ -0,0 +1,199 @@
+import cProfile
+import collections
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from aiohttp import web
+from aiohttp_apispec import validation_middleware
+from aiohttp_security import check_permission
+from marshmallow import ValidationError
+
+from metrics import TRACE, Trace, record_span
+from schemas import ProfileSchema
+from serializers import json_error, json_response, loads
+
+
+logger = logging.getLogger(__name__)
+
+
+class _CProfileSession(object):
+    def __init__(self, conf: dict):
+        self.limit = conf['stats_limit']
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self) -> str:
+        self.profile.disable()
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(self.limit)
+        return stream.getvalue()
+
+
+class _SamplingSession(object):
+    """Периодический снимок стека потока event loop; результат - свернутые стеки для flame graph"""
+
+    def __init__(self, conf: dict):
+        self.interval = conf['sample_interval_ms'] / 1000
+        self.thread_id = threading.get_ident()
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        self._stopped.set()
+        self._thread.join()
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+
+class Profiler(object):
+    """Профилирование следующих N запросов маршрута в текущем процессе
+
+    Профилируется один запрос за раз; профиль охватывает весь поток event loop, поэтому
+    в него попадают и запросы, выполнявшиеся одновременно с профилируемым.
+    """
+
+    MODES = {'cprofile': _CProfileSession, 'sampling': _SamplingSession}
+
+    def __init__(self, conf: dict):
+        self.conf = conf
+        self.route = None
+        self.mode = None
+        self.remaining = 0
+        self.session = None
+        self.results = collections.deque(maxlen=conf['keep_results'])
+
+    def arm(self, route: str, requests: int, mode: str):
+        self.route = route
+        self.mode = mode
+        self.remaining = requests
+
+    def start(self, route: str):
+        """Начало профиля запроса, если маршрут ожидает профилирования и профиль не снимается"""
+        if self.session is not None or self.remaining <= 0 or route != self.route:
+            return None
+        self.remaining -= 1
+        self.session = self.MODES[self.mode](self.conf)
+        self.session.start()
+        return self.session
+
+    def finish(self, request, elapsed: float):
+        output = self.session.stop()
+        self.session = None
+        self.results.append({
+            'route': self.route,
+            'mode': self.mode,
+            'method': request.method,
+            'path': request.path,
+            'duration_ms': round(elapsed * 1000, 2),
+            'output': output,
+        })
+
+    def state(self) -> dict:
+        return {'route': self.route, 'mode': self.mode, 'remaining': self.remaining, 'results': list(self.results)}
+
+
+@web.middleware
+async def tracing_middleware(request, handler):
+    """Трассировка фаз запроса (пул, SQL, хеширование, валидация, JSON), журнал медленных
+    запросов и профилирование по запросу администратора
+
+    Маршруты из streaming_routes (лента изменений) открыты, пока клиент не отключится,
+    и в журнал медленных запросов не пишутся.
+    """
+    conf = request.app['config']['tracing']
+    trace = request['trace'] = Trace()
+    token = TRACE.set(trace)
+    profiler = request.app['profiler']
+    session = profiler.start(request.match_info.route.name)
+    try:
+        return await handler(request)
+    finally:
+        TRACE.reset(token)
+        elapsed = trace.elapsed()
+        if session is not None:
+            profiler.finish(request, elapsed)
+        if elapsed * 1000 >= conf['slow_ms'] \
+                and request.match_info.route.name not in conf['streaming_routes']:
+            logger.warning('Slow request %s %s: %.1f ms (%s)',
+                           request.method, request.path, elapsed * 1000, trace.summary())
+
+
+@web.middleware
+async def traced_validation_middleware(request, handler):
+    """validation_middleware aiohttp_apispec с учетом времени разбора и валидации тела как фазы validation"""
+    started = time.perf_counter()
+    recorded = False
+
+    async def validated(request):
+        nonlocal recorded
+        recorded = True
+        record_span('validation', time.perf_counter() - started)
+        return await handler(request)
+
+    try:
+        return await validation_middleware(request, validated)
+    finally:
+        if not recorded:
+            record_span('validation', time.perf_counter() - started)
+
+
+async def send_server_timing(request, response):
+    """on_response_prepare: заголовок Server-Timing с фазами, завершенными к отправке заголовков
+
+    Не отправляется на маршрутах из server_timing_skip_routes: по наличию фазы hash на login
+    можно отличить существующий логин от несуществующего.
+    """
+    trace = request.get('trace')
+    conf = request.app['config']['tracing']
+    if trace is not None and conf['server_timing'] \
+            and request.match_info.route.name not in conf['server_timing_skip_routes']:
+        response.headers['Server-Timing'] = trace.server_timing()
+
+
+async def profile_state(request):
+    await check_permission(request, 'admin')
+    return json_response(request.app['profiler'].state())
+
+
+async def arm_profile(request):
+    """Профилирование следующих requests запросов маршрута route в режиме cprofile или sampling"""
+    await check_permission(request, 'admin')
+    try:
+        data = ProfileSchema().load(loads(await request.read()))
+    except (ValueError, ValidationError) as e:
+        return json_response({'error': getattr(e, 'messages', str(e))}, status=422)
+
+    if data['route'] not in request.app.router.named_resources():
+        raise json_error(web.HTTPNotFound, 'Route not found')
+    max_requests = request.app['config']['tracing']['profile']['max_requests']
+    requests = min(data['requests'], max_requests)
+    request.app['profiler'].arm(data['route'], requests, data['mode'])
+    return json_response({'route': data['route'], 'requests': requests, 'mode': data['mode']}, status=202)
+
+
+def setup_tracing(app):
+    app['profiler'] = Profiler(app['config']['tracing']['profile'])
+    app.on_response_prepare.append(send_server_timing)
+    app.router.add_route('GET', '/profile', profile_state, name='profile_state')
+    app.router.add_route('POST', '/profile', arm_profile, name='arm_profile')
+    app.middlewares.append(tracing_middleware)
@@ -0,0 +1,137 @@
+import copy
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# задержка перезапуска упавшего процесса удваивается, пока он падает раньше STABLE_AFTER секунд
+RESPAWN_DELAY = 0.5
+RESPAWN_MAX_DELAY = 30
+STABLE_AFTER = 30
+
+
+def create_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """Слушающий сокет, который разделяют все рабочие процессы"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def worker_config(config: dict, workers: int) -> dict:
+    """Конфигурация рабочего процесса: бюджет соединений postgres делится между процессами
+
+    Если процессов больше postgres.maxsize, бюджет не делится без превышения - ValueError.
+    """
+    conf = copy.deepcopy(config)
+    postgres = conf['postgres']
+    if workers > postgres['maxsize']:
+        raise ValueError(f'{workers} workers need postgres.maxsize of at least {workers}, '
+                         f'got {postgres["maxsize"]}')
+    postgres['maxsize'] = postgres['maxsize'] // workers
+    postgres['minsize'] = min(postgres['minsize'], postgres['maxsize'])
+    return conf
+
+
+class Master(object):
+    """Pre-fork мастер: запускает рабочие процессы, перезапускает упавшие с нарастающей задержкой
+
+    SIGHUP - плавный перезапуск: поднимаются новые процессы, старые получают SIGTERM
+    и завершаются после обработки текущих запросов. Новые процессы заново читают конфиг (target),
+    но код модулей, импортированных мастером, не обновляется; не меняются и параметры
+    мастера (адрес сокета, число процессов) - для этого нужен полный перезапуск.
+    SIGTERM/SIGINT - плавная остановка всех процессов.
+    """
+
+    def __init__(self, target, args, workers: int, shutdown_timeout: float):
+        self.target = target
+        self.args = args
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.processes = []
+        self._started = []
+        self._failures = []
+        self._respawn_at = []
+        self._stopping = False
+        self._reloading = False
+
+    def _spawn(self):
+        process = multiprocessing.Process(target=_worker_main, args=(self.target, self.args), daemon=False)
+        process.start()
+        logger.info('Started worker %s', process.pid)
+        return process
+
+    def _start_all(self):
+        self.processes = [self._spawn() for _ in range(self.workers)]
+        self._started = [time.monotonic()] * self.workers
+        self._failures = [0] * self.workers
+        self._respawn_at = [None] * self.workers
+
+    def _check_workers(self):
+        """Перезапуск завершившихся процессов; процесс, упавший вскоре после старта,
+        перезапускается с удвоенной задержкой"""
+        now = time.monotonic()
+        for i, process in enumerate(self.processes):
+            if process.is_alive() or self._stopping:
+                continue
+            if self._respawn_at[i] is None:
+                if now - self._started[i] >= STABLE_AFTER:
+                    self._failures[i] = 0
+                delay = min(RESPAWN_MAX_DELAY, RESPAWN_DELAY * 2 ** self._failures[i])
+                self._failures[i] += 1
+                self._respawn_at[i] = now + delay
+                logger.warning('Worker %s exited with code %s, restarting in %.1f s',
+                               process.pid, process.exitcode, delay)
+            elif now >= self._respawn_at[i]:
+                self.processes[i] = self._spawn()
+                self._started[i] = now
+                self._respawn_at[i] = None
+
+    def _terminate(self, processes):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning('Worker %s did not stop in time, killing', process.pid)
+                process.kill()
+                process.join()
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        self._start_all()
+        while not self._stopping:
+            if self._reloading:
+                self._reloading = False
+                old = self.processes
+                self._start_all()
+                self._terminate(old)
+
+            self._check_workers()
+            time.sleep(0.5)
+
+        self._terminate(self.processes)
+
+
+def _worker_main(target, args):
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+    target(*args)